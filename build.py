@@ -1,52 +1,54 @@
 #!/bin/env python3
 
 import argparse
+import build_cache
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import importlib
+import multiprocessing
 import os
 from pathlib import Path
 import shutil
+import staging
+import sys
+import tempfile
+import traceback
 import zipfile
 
 from manifest import Manifest
 import tools
 from compile import Project, BuildContext
 import ivy_cache_resolver as ivy
-
-
+import extract_batik
+import extract_jacop
+import extract_lucene
+import extract_xalan
+
+# Depth limit of the module graph walked to compute build orders.
+build_order_depth_limit = 6
+
+harness_id = ivy.ID('dacapo', 'harness', '1.0')
+
+# Split runtime classpath 'classpath' of a benchmark into benchmark
+# entries, harness runtime dependencies and the harness jar (None if
+# not on the classpath).
+def split_harness_classpath(classpath):
+    names   = set([ Path(x).name for x in ivy.cache().resolve_dependencies(harness_id, ['runtime']) ])
+    jar     = '-'.join([ harness_id.mod, harness_id.rev ]) + '.jar'
+    bm_cp   = [ x for x in classpath if not Path(x).name in names and Path(x).name != jar ]
+    hs_cp   = [ x for x in classpath if Path(x).name in names and Path(x).name != jar ]
+    harness = next((x for x in classpath if Path(x).name == jar), None)
+    return bm_cp, hs_cp, harness
+
+# The harness ('dacapo:harness:1.0') is a project of its own (see
+# 'harness_1_0'). Benchmarks depend on the harness artifact through ivy
+# (see 'install_benchmark_module' in 'extract-resources.py'), so the
+# harness jar and its dependencies are on the compile and runtime
+# classpaths of benchmarks. The harness locates the deployment from the
+# jar holding its classes, so these are merged into the launcher jar and
+# only its dependencies are deployed into 'jhs/' (see 'bm_deploy').
 def add_harness(bm):
-    dacapo  = Path('dacapo/dacapo')
-    harness = Path('dacapo/harness')
-
-    # TODO
-    # We don't expect the harness to change so this could
-    # be done once when the harness is extracted from dacapo...
-    tools.javacc_7_0_12(
-        harness,
-        { 'OUTPUT_DIRECTORY': 'src/org/dacapo/parser' },
-        [ 'src/org/dacapo/parser/ConfigFile.jj' ]
-    )
-    
-    bm.sources(
-        harness / 'src',
-        include = ['*.java']
-    )
-    bm.sources(
-        dacapo / 'src',
-        include = ['*.java']
-    )
-    bm.resources(
-        dacapo / 'src',
-        include = ['*'],
-        exclude = ['*.java']
-    )
-
-    # Benchmark driver runtime dependencies.
-    bm_rt_cp = [x for x in bm._runtime_classpath]
-
-    # Harness runtime dependencies
-    #hs_rt_cp = ivy.cache().resolve_dependencies(ivy.ID('dacapo', 'harness', '1.0'), ['runtime'])
-    #
-    #bm.extend_compile_classpath(ivy.cache().resolve_dependencies(ivy.ID('dacapo', 'harness', '1.0'), ['compile']))
-    #bm.extend_runtime_classpath(hs_rt_cp)
+    # Benchmark driver and harness runtime dependencies.
+    bm_rt_cp, hs_rt_cp, _ = split_harness_classpath(bm._runtime_classpath)
 
     stem = Path(bm.artifact()).stem
 
@@ -54,7 +56,7 @@ def add_harness(bm):
         # Paths are relative bm launcher deployed in:
         #   <context>/<bm-artifact-name>/
         [ str(Path(stem) / 'jar' / Path(x).name) for x in bm_rt_cp ]
-        #+ [ str(Path(stem) / 'jhs' / Path(x).name) for x in hs_rt_cp ]
+        + [ str(Path(stem) / 'jhs' / Path(x).name) for x in hs_rt_cp ]
     )
 
     bm.manifest = Manifest({
@@ -67,7 +69,8 @@ def add_harness(bm):
 def bm_deploy(context, project):
     # Deployment layout of benchmarks:
     # <cxt>/
-    #   <bm-artifact>.jar    # Manifest Class-Path: <bm-artifact-stem>/{jar,jhs}/*.jar
+    #   <bm-artifact>.jar    # Benchmark and harness classes
+    #                        # Manifest Class-Path: <bm-artifact-stem>/{jar,jhs}/*.jar
     #   <bm-artifact-stem>/  # Example: batik-1.0.jar => batik-1.0/
     #     dat/
     #       - Benchmark data
@@ -97,14 +100,15 @@ def bm_deploy(context, project):
     jar.mkdir()
     jhs.mkdir()
 
-    #harness_runtime = ivy.cache().resolve_dependencies(ivy.ID('dacapo', 'harness', '1.0'), ['runtime'])
-    #for d in harness_runtime:
-    #    shutil.copy2(d, jhs / Path(d).name)
-    #    print("jhs:", jhs / Path(d).name)
+    bm_runtime, harness_runtime, harness_jar = split_harness_classpath(
+        ivy.cache().resolve_dependencies(ivy.ID('dacapo', bm_name, '1.0'), ['runtime'])
+    )
+    for d in harness_runtime:
+        staging.copy(d, jhs / Path(d).name)
+        print("jhs:", jhs / Path(d).name)
 
-    batik_runtime = ivy.cache().resolve_dependencies(ivy.ID('dacapo', bm_name, '1.0'), ['runtime'])
-    for d in batik_runtime:
-        shutil.copy2(d, jar / Path(d).name)
+    for d in bm_runtime:
+        staging.copy(d, jar / Path(d).name)
         print("jar:", jar / Path(d).name)
 
     ## Copy benchmark data into context
@@ -125,17 +129,67 @@ def bm_deploy(context, project):
         target_is_directory = True
     )
 
-    # Deploy artifact from build cache
-    shutil.copy2(ivy.cache().location(project.id) / 'jars' / bm_artifact, path.parent)
+    # Deploy artifact from build cache (not linked, it is modified below)
+    staging.copy(
+        ivy.cache().location(project.id) / 'jars' / bm_artifact,
+        path.parent / bm_artifact,
+        writable = True
+    )
     
     context_art = path.parent / bm_artifact
 
+    # Merge harness classes and resources into the launcher, keeping
+    # the launcher manifest and entries.
+    if not harness_jar is None:
+        print("Merging", harness_jar, "into", context_art)
+        with zipfile.ZipFile(harness_jar, 'r') as src, zipfile.ZipFile(context_art, 'a') as f:
+            names = set(f.namelist())
+            for info in src.infolist():
+                if info.filename == 'META-INF/MANIFEST.MF' or info.filename in names:
+                    continue
+                f.writestr(info, src.read(info), info.compress_type)
+
     # TODO: Fix later if needed.
     with zipfile.ZipFile(context_art, 'a') as f:
         # For now, add empty files to make the harness run.
         f.writestr('META-INF/md5/' + bm_name + '.MD5', bytes())
         f.writestr('META-INF/yml/' + bm_name + '.yml', bytes())
 
+def harness_1_0():
+    id      = harness_id
+    harness = Project('projects/harness-1.0', id)
+    dacapo  = Path('dacapo/dacapo')
+    hs      = Path('dacapo/harness')
+
+    # Generated files are restored from 'build/javacc-cache/' unless the
+    # grammar changed (see 'tools.javacc').
+    tools.javacc_7_0_12(
+        hs,
+        { 'OUTPUT_DIRECTORY': 'src/org/dacapo/parser' },
+        [ 'src/org/dacapo/parser/ConfigFile.jj' ]
+    )
+
+    harness.sources(
+        hs / 'src',
+        include = ['*.java']
+    )
+    harness.sources(
+        dacapo / 'src',
+        include = ['*.java']
+    )
+    harness.resources(
+        dacapo / 'src',
+        include = ['*'],
+        exclude = ['*.java']
+    )
+    harness.extend_compile_classpath(ivy.cache().resolve_dependencies(id, ['compile']))
+    harness.extend_runtime_classpath(ivy.cache().resolve_dependencies(id, ['runtime']))
+    harness.manifest = Manifest({
+        'Manifest-Version'     : '1.0',
+        'Specification-Vendor' : 'DaCapo'
+    })
+    return harness
+
 def bm_build(name):
     id = ivy.ID('dacapo', name, '1.0')
     bm = Project('projects/' + name, id)
@@ -316,10 +370,175 @@ def jacop_4_10_0():
     })
     return jacop
 
+# Fill 'ivy-cache/' and 'downloads/' ahead of '--offline' builds.
+# Archives are fetched while ivy resolves the graphs of all projects,
+# and classpaths of all projects are resolved concurrently. Requires
+# extracted resources (see 'extract-resources.py').
+def prewarm(projects, project_confs, workers):
+    extract_resources = importlib.import_module('extract-resources')
+    archives = [
+        extract_batik.source_archive,
+        extract_jacop.source_archive,
+        extract_lucene.source_archive,
+        extract_xalan.source_archive
+    ] + [
+        (url + '/' + file, file, md5) for url, file, md5 in extract_resources.bm_data_files.values()
+    ]
+    ids = [ ivy.ID.from_coord(coord) for coord in projects ]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        fetched = [ pool.submit(tools.fetch, url, file, md5) for url, file, md5 in archives ]
+        for id in ids:
+            ivy.cache().compute_build_order(id, depth_limit = build_order_depth_limit)
+        resolved = [
+            pool.submit(ivy.cache().resolve_dependencies, id, confs)
+            for id in ids
+            for confs in project_confs.get(id.coord(), [['compile'], ['runtime']])
+        ]
+        for future in fetched + resolved:
+            future.result()
+
+# Raise if any files needed by an '--offline' build are missing.
+def check_offline(missing):
+    if len(missing) == 0:
+        return
+    print("Missing from cache (offline)")
+    for path in missing:
+        print(" ", path)
+    raise ValueError('Offline mode. Files missing from cache', len(missing))
+
+# Return { <coord> : [ <coord> ] } mapping each source project in the
+# build order to the source projects it depends on, directly or through
+# modules without source. Only dependencies earlier in the build order
+# are kept, so the result is a DAG even if the module graph has cycles.
+#
+# Dependencies are the declared dependencies of each module in 'cache'
+# (the edges of 'graph' only cover modules visited within the depth
+# limit). A project reaching a module whose definition is not in the
+# cache depends on all source projects before it in the build order.
+def source_project_graph(cache, graph, projects):
+    order    = graph['build_order']
+    edges    = graph['edges']
+    position = { id : i for i, id in enumerate(order) }
+    sources  = [ id for id in order if id.coord() in projects ]
+    result   = dict()
+
+    def declared(id):
+        dependencies = cache.declared_dependencies(id)
+        if dependencies is None:
+            dependencies = edges.get(id)
+        return dependencies
+
+    for id in sources:
+        deps    = set()
+        unknown = False
+        stack   = list(declared(id) or [])
+        visited = set(stack)
+        while len(stack) > 0 and not unknown:
+            dep = stack.pop()
+            if dep.coord() in projects:
+                deps.add(dep)
+                continue
+            dependencies = declared(dep)
+            if dependencies is None:
+                unknown = True
+                continue
+            for next in dependencies:
+                if not next in visited:
+                    visited.add(next)
+                    stack.append(next)
+        if unknown or declared(id) is None:
+            deps = set(sources)
+        deps = [ dep for dep in deps if dep in position and position[dep] < position[id] ]
+        result[id.coord()] = [ dep.coord() for dep in sorted(deps, key = lambda dep: position[dep]) ]
+    return result
+
+# Project definitions of the current build. Set before build workers
+# are forked (definitions are lambdas which cannot be pickled).
+_build_projects = None
+
+# Build project in a worker process and return (<ok>, <output>).
+# Output is captured at the file descriptor level to include output
+# of javac and other subprocesses.
+def _build_project(coord, clean):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    ok    = True
+    with tempfile.TemporaryFile() as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            _build_projects[coord]().build(clean)
+        except Exception:
+            traceback.print_exc()
+            ok = False
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+        log.seek(0)
+        return ok, log.read().decode('utf-8', errors = 'replace')
+
+# Build source projects in 'order' using 'jobs' worker processes. A
+# project is started when all its 'dependencies' are built, earliest in
+# the build order first. Output of each project is printed as one block
+# when the project completes. Projects depending on a failed project
+# are not built.
+def build_parallel(projects, order, dependencies, clean, jobs):
+    global _build_projects
+    _build_projects = projects
+
+    position   = { coord : i for i, coord in enumerate(order) }
+    dependents = { coord : [] for coord in order }
+    waiting    = dict()
+    for coord in order:
+        waiting[coord] = len(dependencies[coord])
+        for dep in dependencies[coord]:
+            dependents[dep].append(coord)
+
+    built   = []
+    failed  = []
+    ready   = [ coord for coord in order if waiting[coord] == 0 ]
+    running = dict()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers = jobs, mp_context = context) as pool:
+        while len(ready) > 0 or len(running) > 0:
+            for coord in sorted(ready, key = lambda c: position[c]):
+                print("[jobs] Building", coord)
+                running[pool.submit(_build_project, coord, clean)] = coord
+            ready = []
+            done = wait(running, return_when = FIRST_COMPLETED)[0]
+            for future in sorted(done, key = lambda f: position[running[f]]):
+                coord      = running.pop(future)
+                ok, output = future.result()
+                print("[jobs] Output of", coord, "(ok)" if ok else "(failed)")
+                print(output, end = '')
+                if not ok:
+                    failed.append(coord)
+                    continue
+                built.append(coord)
+                for dependent in dependents[coord]:
+                    waiting[dependent] = waiting[dependent] - 1
+                    if waiting[dependent] == 0:
+                        ready.append(dependent)
+
+    if len(failed) > 0:
+        cancelled = [ coord for coord in order if not coord in built and not coord in failed ]
+        print("[jobs] Failed")
+        for coord in failed:
+            print(" ", coord)
+        print("[jobs] Cancelled (depends on failed project)")
+        for coord in cancelled:
+            print(" ", coord)
+        raise ValueError('Build failed', failed)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--project', required = True,
-        help = "Coordinate of project to operate on")
+    parser.add_argument('--project', required = False,
+        help = "Coordinate of project to operate on (required unless '--prewarm' is specified)")
     parser.add_argument('--context', required = True,
         help = "Build context folder for export/import")
     parser.add_argument('--export' , required = False, action = "store_true",
@@ -336,12 +555,60 @@ if __name__ == '__main__':
         help = "Import folder with patched '-build.zip' files.")
     parser.add_argument('--target-version', required = False,
         help = "The target version to use when compiling source code")
+    parser.add_argument('--ivy-daemon', required = False, action = "store_true",
+        help = "Answer ivy requests using a long-lived ivy worker instead of one JVM per request")
+    parser.add_argument('--batch-resolve', required = False, action = "store_true",
+        help = "Resolve classpaths of all source projects in the build order in one ivy run")
+    parser.add_argument('--resolve-workers', required = False, type = int, default = 4,
+        help = "Number of module definitions fetched concurrently when computing the build order")
+    parser.add_argument('--classpath-engine', required = False, default = 'ivy', choices = ['ivy', 'python', 'verify'],
+        help = "Compute classpaths using ivy, from the ivy cache in python (ivy on a miss), or verify python against ivy")
+    parser.add_argument('--offline', required = False, action = "store_true",
+        help = "Resolve only from 'ivy-cache/' and 'downloads/' and fail fast listing missing files")
+    parser.add_argument('--prewarm', required = False, action = "store_true",
+        help = "Fill 'ivy-cache/' and 'downloads/' for all projects and exit")
+    parser.add_argument('--incremental', required = False, action = "store_true",
+        help = "Recompile only changed sources and their dependents into the existing 'build/dist'")
+    parser.add_argument('--javac-server', required = False, action = "store_true",
+        help = "Compile using a resident javac server instead of starting javac for each project")
+    parser.add_argument('--javac-jobs', required = False, type = int, default = 1,
+        help = "Compile each project in up to this many concurrent javac shards (package groups)")
+    parser.add_argument('-j', '--jobs', required = False, type = int, default = 1,
+        help = "Number of source projects built concurrently in worker processes")
+    parser.add_argument('--staging', required = False, default = 'copy', choices = staging.strategies,
+        help = "How files are staged into build trees, deployments and the build cache")
+    parser.add_argument('--zip-level', required = False, type = int, default = 6, choices = range(10),
+        help = "Compression level of jars and zip files (0 stores entries uncompressed)")
+    parser.add_argument('--zip-workers', required = False, type = int, default = None,
+        help = "Number of threads compressing entries of jars and zip files (default: number of CPUs)")
+    parser.add_argument('--reproducible', required = False, action = "store_true",
+        help = "Write byte-identical jars and zip files for identical inputs (sorted entries, fixed times and modes)")
+    parser.add_argument('--build-cache', required = False,
+        help = "Shared artifact cache (folder or http(s) URL of 'build_cache.py --serve')")
+    parser.add_argument('--build-cache-read-only', required = False, action = "store_true",
+        help = "Pull artifacts from the shared cache but do not push built artifacts")
+    parser.add_argument('--lockfile', required = False,
+        help = "Read resolved classpaths from this file if it exists and record newly resolved classpaths into it")
     args = parser.parse_args()
 
     if args.verbose:
         print("Using build context")
         print("  path = " + args.context)
 
+    if args.offline:
+        ivy.set_offline(True)
+        tools.set_offline(True)
+
+    staging.set_strategy(args.staging)
+    tools.set_zip_options(args.zip_level, args.zip_workers, args.reproducible)
+    build_cache.set_remote(args.build_cache, args.build_cache_read_only)
+
+    if args.ivy_daemon:
+        ivy.cache().use_daemon()
+
+    ivy.cache().set_workers(args.resolve_workers)
+    ivy.cache().set_classpath_engine(args.classpath_engine)
+
     Project._global_build_context = BuildContext(args.context, args)
 
     projects = {
@@ -368,6 +635,9 @@ if __name__ == '__main__':
         # The following benchmarks are provided by this suite.
         'dacapo:jacop:1.0'                                : lambda: bm_build('jacop'),
 
+        # The benchmark harness (driver) shared by all benchmarks.
+        'dacapo:harness:1.0'                              : harness_1_0,
+
         # The following projects are libraries referenced by benchmark projects.
         'org.apache.xmlgraphics:batik-all:1.16'           : batik_1_16,
         'org.apache.lucene:lucene-analysis-common:9.10.0' : lambda: lucene_9_10_0('analysis-common'),
@@ -384,16 +654,37 @@ if __name__ == '__main__':
         'org.jacop:jacop:4.10.0'                          : jacop_4_10_0,
     }
 
+    # Classpath configurations resolved by the project definitions above
+    # (one classpath per list of configurations). Projects not listed
+    # resolve 'compile' and 'runtime'.
+    project_confs = {
+        'xalan:xalan:2.7.2'                               : [['compile,optional'], ['runtime,optional']],
+        'org.jacop:jacop:4.10.0'                          : [['compile', 'test'], ['runtime']],
+    }
+
+    if args.lockfile:
+        # Jars of source projects are replaced by the build and are not pinned.
+        ivy.cache().use_lockfile(args.lockfile, [ ivy.ID.from_coord(coord) for coord in projects ])
+
+    if args.prewarm:
+        prewarm(projects, project_confs, args.resolve_workers)
+        sys.exit(0)
+
     if not args.project in projects:
         raise ValueError("Missing build for specified project", args.project)
 
+    project_id = ivy.ID.from_coord(args.project)
+
+    if args.offline:
+        check_offline(ivy.cache().find_missing(project_id, build_order_depth_limit))
+
     if args.verbose:
         print("Computing build order ...")
 
     build_order = ivy.cache().compute_build_order(
-        ivy.ID.from_coord(args.project),
+        project_id,
         verbose = args.verbose,
-        depth_limit = 6
+        depth_limit = build_order_depth_limit
     )
 
     if args.verbose:
@@ -413,14 +704,43 @@ if __name__ == '__main__':
                     if pc in projects:
                         source_projects_txt.write(pc + os.linesep)
 
-    for coord in [id.coord() for id in build_order]:
-        if coord in projects:
-            project = projects[coord]()
-            project.build(args.clean)
+    classpath_requests = [
+        (id, confs)
+        for id in build_order if id.coord() in projects
+        for confs in project_confs.get(id.coord(), [['compile'], ['runtime']])
+    ]
 
-    # Note that 'export' depends on 'build' to generate 'build.zip'
-    # in each source project. All source projects associated with
-    # the specified project are held by build_order.
+    if args.offline:
+        check_offline(ivy.cache().find_missing(project_id, build_order_depth_limit, classpath_requests))
+
+    if args.batch_resolve:
+        # Project definitions read classpaths resolved here from the cache.
+        ivy.cache().resolve_dependencies_batch(classpath_requests)
+
+    if args.jobs > 1:
+        # Resolve classpaths once in the parent so that workers find
+        # them in the cache instead of resolving (and locking) them
+        # concurrently.
+        for id, confs in classpath_requests:
+            ivy.cache().resolve_dependencies(id, confs)
+        graph = ivy.cache().build_graph(project_id, depth_limit = build_order_depth_limit)
+        build_parallel(
+            projects,
+            [ id.coord() for id in build_order if id.coord() in projects ],
+            source_project_graph(ivy.cache(), graph, projects),
+            args.clean,
+            args.jobs
+        )
+    else:
+        for coord in [id.coord() for id in build_order]:
+            if coord in projects:
+                project = projects[coord]()
+                project.build(args.clean)
+
+    # Note that 'export' depends on 'build' to record the source tree
+    # of each source project ('var/tree/'), from which 'build.zip' is
+    # written. All source projects associated with the specified
+    # project are held by build_order.
     if args.export:
         if args.export_path:
             ep = Path(args.export_path)
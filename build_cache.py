@@ -0,0 +1,399 @@
+#!/bin/env python3
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import urllib.error
+import urllib.request
+
+# Version of the key format. Change to invalidate all cached actions.
+_version = 1
+
+# { <path> : (<size>, <mtime_ns>, <sha256>) }
+_digests = dict()
+
+# { <JAVA_HOME> : <output of 'javac -version'> }
+_javac_versions = dict()
+
+# Return the sha256 digest of file 'path'. Digests are kept for the
+# lifetime of the process and reused while size and modification time
+# of the file are unchanged (classpath jars are shared by many projects).
+def file_digest(path):
+    path = os.path.abspath(path)
+    st   = os.stat(path)
+    entry = _digests.get(path)
+    if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+    with open(path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()
+    _digests[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+# Return the digest of a classpath entry (jar or class folder), or None
+# if it does not exist.
+def path_digest(path):
+    if os.path.isfile(path):
+        return file_digest(path)
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha256()
+    for d, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file = os.path.join(d, name)
+            h.update(os.path.relpath(file, path).encode('utf-8') + b'\0')
+            h.update(file_digest(file).encode('utf-8') + b'\n')
+    return h.hexdigest()
+
+# Return the output of '${JAVA_HOME}/bin/javac -version' (written to
+# stderr by JDK 8), or None if javac cannot be run.
+def javac_version(java_home):
+    if not java_home in _javac_versions:
+        try:
+            p = subprocess.run(
+                [ str(Path(java_home or '') / 'bin/javac'), '-version' ],
+                stdout = subprocess.PIPE,
+                stderr = subprocess.STDOUT,
+                check  = True
+            )
+            _javac_versions[java_home] = p.stdout.decode('utf-8', errors = 'replace').strip()
+        except (OSError, subprocess.CalledProcessError):
+            _javac_versions[java_home] = None
+    return _javac_versions[java_home]
+
+# Return the key of an action with 'inputs' (JSON data).
+def action_key(inputs):
+    data = json.dumps([ _version, inputs ], sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+# Cache of action outputs keyed by a digest over all inputs of the
+# action (see 'compile.Project._deploy').
+#
+# Layout
+#   <folder>/<key>/action.json -- Inputs of the action
+#   <folder>/<key>/<output>    -- Output of the action
+#
+# The output is written first and 'action.json' last, so an entry is
+# complete if 'action.json' exists. The modification time of
+# 'action.json' is the time of last use. Only the 'keep' most recently
+# used entries are kept.
+#
+# Usage
+#   cache  = ActionCache(project / 'var/actions')
+#   key    = action_key(inputs)
+#   output = cache.output(key, name)
+#   if not cache.contains(key):
+#       ... # Write 'output'
+#       cache.commit(key, inputs)
+class ActionCache:
+    def __init__(self, folder, keep = 4):
+        self._folder = Path(folder)
+        self._keep   = keep
+
+    def _action_file(self, key):
+        return self._folder / key / 'action.json'
+
+    # Return path of output 'name' of action 'key'.
+    def output(self, key, name):
+        return self._folder / key / name
+
+    # Return True if action 'key' is complete, and mark it as used.
+    def contains(self, key):
+        path = self._action_file(key)
+        if not path.exists():
+            return False
+        os.utime(path)
+        return True
+
+    # Prepare the entry of action 'key' for writing its outputs.
+    def begin(self, key):
+        entry = self._folder / key
+        if entry.exists():
+            shutil.rmtree(entry) # Incomplete entry.
+        entry.mkdir(parents = True)
+
+    # Record action 'key' with 'inputs' as complete, and remove least
+    # recently used entries.
+    def commit(self, key, inputs):
+        path = self._action_file(key)
+        temp = path.with_suffix('.tmp' + str(os.getpid()))
+        with open(temp, 'w') as f:
+            json.dump({ 'key' : key, 'inputs' : inputs }, f, indent = 2, sort_keys = True)
+        os.replace(temp, path)
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        for entry in self._folder.iterdir():
+            try:
+                entries.append((os.stat(entry / 'action.json').st_mtime_ns, entry))
+            except OSError:
+                continue # Incomplete (or being written by another build).
+        for mtime, entry in sorted(entries, reverse = True)[self._keep:]:
+            print("[actions] Remove", entry)
+            shutil.rmtree(entry, ignore_errors = True)
+
+# Shared cache of action outputs (see 'set_remote'), or None.
+_remote           = None
+_remote_read_only = False
+
+# Keys are action keys, names are output file names.
+_key_re  = re.compile(r'^[0-9a-f]{64}$')
+_name_re = re.compile(r'^[A-Za-z0-9._+-]+$')
+
+def _check(key, name):
+    if _key_re.match(key) is None or _name_re.match(name) is None or name.startswith('.'):
+        raise ValueError('Bad action output', key, name)
+
+# Copy 'src' to 'dst' through a temporary file and return the sha256
+# digest of the copied content. 'dst' is not replaced if the digest is
+# not 'digest' (unless None).
+def _copy_verified(src, dst, digest = None):
+    fd, temp = tempfile.mkstemp(dir = Path(dst).parent, prefix = Path(dst).name + '.tmp')
+    h        = hashlib.sha256()
+    try:
+        with open(fd, 'wb') as f:
+            os.fchmod(fd, 0o644) # Not private (shared caches).
+            while True:
+                chunk = src.read(1024 * 1024)
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+        if not digest is None and h.hexdigest() != digest:
+            raise ValueError('Checksum mismatch', str(dst), digest, h.hexdigest())
+        os.replace(temp, dst)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return h.hexdigest()
+
+# Shared cache in a folder (local or NFS). Outputs are stored in
+#   <folder>/<key[:2]>/<key>/<name>
+#   <folder>/<key[:2]>/<key>/<name>.sha256
+# Both are written through temporary files and the digest last, so an
+# output is complete if its digest exists.
+class DirectoryBackend:
+    def __init__(self, folder):
+        self._folder = Path(folder)
+
+    def __str__(self):
+        return str(self._folder)
+
+    def _path(self, key, name):
+        _check(key, name)
+        return self._folder / key[:2] / key / name
+
+    def _digest_path(self, key, name):
+        return self._path(key, name).with_name(name + '.sha256')
+
+    # Return (<digest>, <file object>) of output 'name' of action 'key',
+    # or None if not in the cache.
+    def open(self, key, name):
+        try:
+            digest = self._digest_path(key, name).read_text(encoding = 'utf-8').strip()
+            return digest, open(self._path(key, name), 'rb')
+        except FileNotFoundError:
+            return None
+
+    # Copy output 'name' of action 'key' to 'dst'. Return False if not in
+    # the cache.
+    def get(self, key, name, dst):
+        entry = self.open(key, name)
+        if entry is None:
+            return False
+        with entry[1] as f:
+            _copy_verified(f, dst, entry[0])
+        return True
+
+    # Store 'src' (a file object) with 'digest' as output 'name' of
+    # action 'key'.
+    def put(self, key, name, src, digest):
+        path = self._path(key, name)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        _copy_verified(src, path, digest)
+        _copy_verified(io.BytesIO((digest + '\n').encode('utf-8')), self._digest_path(key, name))
+
+# Shared cache behind an HTTP server (see '--serve'). Outputs are read
+# with 'GET <url>/<key>/<name>' and written with 'PUT <url>/<key>/<name>'.
+# The sha256 digest of the content is sent in the 'X-Checksum-Sha256'
+# header and verified by the receiver.
+class HttpBackend:
+    _timeout = 30
+
+    def __init__(self, url):
+        self._url = url.rstrip('/')
+
+    def __str__(self):
+        return self._url
+
+    def _url_of(self, key, name):
+        _check(key, name)
+        return self._url + '/' + key + '/' + name
+
+    def get(self, key, name, dst):
+        try:
+            with urllib.request.urlopen(self._url_of(key, name), timeout = HttpBackend._timeout) as response:
+                digest = response.headers.get('X-Checksum-Sha256')
+                if digest is None:
+                    raise ValueError('Missing checksum', self._url_of(key, name))
+                _copy_verified(response, dst, digest)
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def put(self, key, name, src, digest):
+        request = urllib.request.Request(
+            self._url_of(key, name),
+            data    = src,
+            method  = 'PUT',
+            headers = {
+                'Content-Length'    : str(os.fstat(src.fileno()).st_size),
+                'Content-Type'      : 'application/octet-stream',
+                'X-Checksum-Sha256' : digest
+            }
+        )
+        with urllib.request.urlopen(request, timeout = HttpBackend._timeout):
+            pass
+
+# Return the backend of 'location' (a folder or an http(s) URL).
+def backend(location):
+    if location.startswith('http://') or location.startswith('https://'):
+        return HttpBackend(location)
+    return DirectoryBackend(location)
+
+# Use the shared cache at 'location' (see 'backend'). Outputs are pushed
+# to it unless 'read_only'.
+def set_remote(location, read_only = False):
+    global _remote, _remote_read_only
+    _remote           = None if location is None else backend(location)
+    _remote_read_only = read_only
+
+# Copy output 'name' of action 'key' from the shared cache to 'dst'.
+# Return False if there is no shared cache, the output is not in it, or
+# it cannot be read (the build continues without it).
+def pull(key, name, dst):
+    if _remote is None:
+        return False
+    try:
+        if _remote.get(key, name, dst):
+            print("[cache] Pulled", name, "from", _remote)
+            return True
+    except (OSError, ValueError) as e:
+        print("[cache] Failed to pull", name, "from", _remote, e)
+    return False
+
+# Copy output 'src' of action 'key' to the shared cache.
+def push(key, src):
+    if _remote is None or _remote_read_only:
+        return
+    src = Path(src)
+    try:
+        with open(src, 'rb') as f:
+            _remote.put(key, src.name, f, file_digest(src))
+        print("[cache] Pushed", src.name, "to", _remote)
+    except (OSError, ValueError) as e:
+        print("[cache] Failed to push", src.name, "to", _remote, e)
+
+# HTTP front of a 'DirectoryBackend' (see '--serve').
+class _Handler(BaseHTTPRequestHandler):
+    backend = None
+
+    def _parse(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            if len(parts) != 2:
+                raise ValueError('Bad path', self.path)
+            _check(*parts)
+        except ValueError:
+            self.send_error(400)
+            return None
+        return parts
+
+    def do_GET(self):
+        parts = self._parse()
+        if parts is None:
+            return
+        entry = self.backend.open(*parts)
+        if entry is None:
+            self.send_error(404)
+            return
+        with entry[1] as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.send_header('X-Checksum-Sha256', entry[0])
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        parts = self._parse()
+        if parts is None:
+            return
+        digest = self.headers.get('X-Checksum-Sha256')
+        length = self.headers.get('Content-Length')
+        if digest is None or length is None:
+            self.send_error(400)
+            return
+        try:
+            self.backend.put(parts[0], parts[1], _LimitedReader(self.rfile, int(length)), digest)
+        except ValueError:
+            self.send_error(422)
+            return
+        except OSError:
+            self.send_error(500)
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+# Read at most 'length' bytes of 'f' (the request body).
+class _LimitedReader:
+    def __init__(self, f, length):
+        self._f      = f
+        self._length = length
+
+    def read(self, size):
+        data = self._f.read(min(size, self._length))
+        self._length = self._length - len(data)
+        return data
+
+# Uploads are not authenticated. The digest only detects corrupted
+# transfers, so bind to a trusted interface (loopback by default).
+def serve(folder, port, host = '127.0.0.1'):
+    _Handler.backend = DirectoryBackend(folder)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    print("[cache] Serving", folder, "on", server.server_address[0], "port", server.server_address[1])
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder",
+                        help = "Action cache to print (e.g. 'projects/<project>/var/actions'), or shared cache to serve")
+    parser.add_argument("--serve", required = False, action = "store_true",
+                        help = "Serve the shared cache in 'folder' over HTTP (see '--build-cache' of 'build.py')")
+    parser.add_argument("--port", required = False, type = int, default = 8642,
+                        help = "Port of '--serve'")
+    parser.add_argument("--host", required = False, default = '127.0.0.1',
+                        help = "Address '--serve' binds to (uploads are not authenticated)")
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.folder, args.port, args.host)
+    else:
+        for entry in sorted(Path(args.folder).iterdir()):
+            path = entry / 'action.json'
+            if not path.exists():
+                print(entry.name, "(incomplete)")
+                continue
+            with open(path, 'r') as f:
+                print(entry.name, json.dumps(json.load(f)['inputs'], indent = 2, sort_keys = True))
@@ -0,0 +1,205 @@
+#!/bin/env python3
+
+import argparse
+import re
+import struct
+
+# Minimal class file reader (JVMS chapter 4) used by incremental
+# compilation in 'compile.py'. Reads the constant pool, the class name,
+# the 'SourceFile' attribute, and compile-time constants of fields.
+
+_CONSTANT_Utf8               = 1
+_CONSTANT_Integer            = 3
+_CONSTANT_Float              = 4
+_CONSTANT_Long               = 5
+_CONSTANT_Double             = 6
+_CONSTANT_Class              = 7
+_CONSTANT_String             = 8
+_CONSTANT_Fieldref           = 9
+_CONSTANT_Methodref          = 10
+_CONSTANT_InterfaceMethodref = 11
+_CONSTANT_NameAndType        = 12
+_CONSTANT_MethodHandle       = 15
+_CONSTANT_MethodType         = 16
+_CONSTANT_Dynamic            = 17
+_CONSTANT_InvokeDynamic      = 18
+_CONSTANT_Module             = 19
+_CONSTANT_Package            = 20
+
+# Size in bytes of constant pool entries other than 'CONSTANT_Utf8'.
+_constant_sizes = {
+    _CONSTANT_Integer            : 4,
+    _CONSTANT_Float              : 4,
+    _CONSTANT_Long               : 8,
+    _CONSTANT_Double             : 8,
+    _CONSTANT_Class              : 2,
+    _CONSTANT_String             : 2,
+    _CONSTANT_Fieldref           : 4,
+    _CONSTANT_Methodref          : 4,
+    _CONSTANT_InterfaceMethodref : 4,
+    _CONSTANT_NameAndType        : 4,
+    _CONSTANT_MethodHandle       : 3,
+    _CONSTANT_MethodType         : 2,
+    _CONSTANT_Dynamic            : 4,
+    _CONSTANT_InvokeDynamic      : 4,
+    _CONSTANT_Module             : 2,
+    _CONSTANT_Package            : 2
+}
+
+_ACC_PRIVATE = 0x0002
+_ACC_STATIC  = 0x0008
+_ACC_FINAL   = 0x0010
+
+# Class names in field and method descriptors and generic signatures.
+_descriptor_class = re.compile(r'L([^;<>:\[]+)[;<]')
+
+class ClassFile:
+    def __init__(self, data):
+        self._data = data
+        self._pos  = 0
+
+        if self._u4() != 0xCAFEBABE:
+            raise ValueError('Not a class file')
+        self._u2() # minor_version
+        self._u2() # major_version
+
+        self._pool = self._read_constant_pool()
+
+        self.access_flags = self._u2()
+        self.name         = self._class_name(self._u2())
+        super_class       = self._u2()
+        self.super_name   = self._class_name(super_class) if super_class != 0 else None
+        for i in range(self._u2()):
+            self._u2() # interfaces (also referenced from the constant pool)
+
+        # { <field name> : <value> } of non-private 'static final' fields
+        # with a 'ConstantValue' attribute. Such constants are inlined by
+        # javac into classes using them.
+        self.constants = dict()
+        for i in range(self._u2()):
+            access_flags = self._u2()
+            name         = self._utf8(self._u2())
+            self._u2() # descriptor_index
+            for j in range(self._u2()):
+                attribute = self._utf8(self._u2())
+                length    = self._u4()
+                if attribute == 'ConstantValue' and access_flags & (_ACC_STATIC | _ACC_FINAL) == (_ACC_STATIC | _ACC_FINAL) and not access_flags & _ACC_PRIVATE:
+                    self.constants[name] = self._constant_value(struct.unpack_from('>H', data, self._pos)[0])
+                self._pos = self._pos + length
+
+        for i in range(self._u2()):
+            self._u2() # access_flags
+            self._u2() # name_index
+            self._u2() # descriptor_index
+            self._skip_attributes()
+
+        self.source_file = None
+        for i in range(self._u2()):
+            attribute = self._utf8(self._u2())
+            length    = self._u4()
+            if attribute == 'SourceFile':
+                self.source_file = self._utf8(struct.unpack_from('>H', data, self._pos)[0])
+            self._pos = self._pos + length
+
+        self._data = None
+
+    def load(path):
+        with open(path, 'rb') as f:
+            return ClassFile(f.read())
+
+    def _u2(self):
+        value     = struct.unpack_from('>H', self._data, self._pos)[0]
+        self._pos = self._pos + 2
+        return value
+
+    def _u4(self):
+        value     = struct.unpack_from('>I', self._data, self._pos)[0]
+        self._pos = self._pos + 4
+        return value
+
+    # Return list of (<tag>, <value>) indexed by constant pool index.
+    # The value of 'CONSTANT_Utf8' entries is the decoded string, and
+    # the raw bytes of the entry otherwise.
+    def _read_constant_pool(self):
+        count = self._u2()
+        pool  = [ None ] * count
+        i     = 1
+        while i < count:
+            tag = self._data[self._pos]
+            self._pos = self._pos + 1
+            if tag == _CONSTANT_Utf8:
+                length    = self._u2()
+                value     = self._data[self._pos:self._pos + length].decode('utf-8', errors = 'replace')
+                self._pos = self._pos + length
+            elif tag in _constant_sizes:
+                size      = _constant_sizes[tag]
+                value     = self._data[self._pos:self._pos + size]
+                self._pos = self._pos + size
+            else:
+                raise ValueError('Unknown constant pool tag', tag, i)
+            pool[i] = (tag, value)
+            # Long and double constants take two entries.
+            i = i + (2 if tag in [_CONSTANT_Long, _CONSTANT_Double] else 1)
+        return pool
+
+    def _utf8(self, index):
+        return self._pool[index][1]
+
+    def _class_name(self, index):
+        return self._utf8(struct.unpack('>H', self._pool[index][1])[0])
+
+    def _constant_value(self, index):
+        tag, value = self._pool[index]
+        if tag == _CONSTANT_Integer:
+            return struct.unpack('>i', value)[0]
+        if tag == _CONSTANT_Float:
+            return value.hex() # Compare bit patterns (NaN).
+        if tag == _CONSTANT_Long:
+            return struct.unpack('>q', value)[0]
+        if tag == _CONSTANT_Double:
+            return value.hex()
+        if tag == _CONSTANT_String:
+            return self._utf8(struct.unpack('>H', value)[0])
+        raise ValueError('Unexpected constant value tag', tag)
+
+    def _skip_attributes(self):
+        for i in range(self._u2()):
+            self._u2() # attribute_name_index
+            length    = self._u4()
+            self._pos = self._pos + length
+
+    # Return set of internal names of classes referenced by this class,
+    # excluding the class itself. Includes classes that only appear in
+    # descriptors and signatures (e.g. parameter and annotation types).
+    def references(self):
+        names = set()
+        for entry in self._pool:
+            if entry is None:
+                continue
+            tag, value = entry
+            if tag == _CONSTANT_Class:
+                name = self._utf8(struct.unpack('>H', value)[0])
+                if name.startswith('['):
+                    names.update(_descriptor_class.findall(name))
+                else:
+                    names.add(name)
+            elif tag == _CONSTANT_Utf8 and 'L' in value and ';' in value:
+                names.update(_descriptor_class.findall(value))
+        names.discard(self.name)
+        return names
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("classfile", nargs = "+",
+                        help = "Class files to print")
+    args = parser.parse_args()
+
+    for path in args.classfile:
+        cf = ClassFile.load(path)
+        print(path)
+        print("  name       ", cf.name)
+        print("  super      ", cf.super_name)
+        print("  source file", cf.source_file)
+        print("  constants  ", cf.constants)
+        for name in sorted(cf.references()):
+            print("  ->", name)
@@ -1,23 +1,155 @@
 #!/bin/env python
 
 import argparse
+import build_cache
+from build_cache import ActionCache
+from classfile import ClassFile
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import fnmatch
+import hashlib
 import itertools
+import json
 from manifest import Manifest
 import os
-from pathlib import Path
+from pathlib import Path, PurePath
+import re
 import shutil
+import socket
+import staging
+from staging import SnapshotIndex, TreeStore
 import subprocess
 import tempfile
+import time
 import ivy_cache_resolver as ivy
 import tools
 
-def javac_fn(options_file, sources_file):
+# Client of the resident javac in 'tools/javac-server/JavacServer.java'.
+#
+# One server is started per JAVA_HOME and shared by all builds in this
+# checkout. The server keeps the JIT-compiled compiler warm between
+# projects and exits by itself after '_idle_timeout' seconds without
+# requests. The port file ('build/javac-server/<key>.port') holds the
+# port and a random token required by the server.
+class JavacServer:
+    _source       = 'tools/javac-server/JavacServer.java'
+    _folder       = Path('build/javac-server')
+    _idle_timeout = 1800
+    _instance     = None
+
+    def instance():
+        if JavacServer._instance is None:
+            JavacServer._instance = JavacServer(os.environ.get('JAVA_HOME'))
+        return JavacServer._instance
+
+    def __init__(self, java_home):
+        self._java_home = java_home
+        self._dead      = java_home is None
+        if java_home is not None:
+            key             = hashlib.sha256(java_home.encode('utf-8')).hexdigest()[:16]
+            self._port_file = JavacServer._folder / (key + '.port')
+            self._lock_file = JavacServer._folder / (key + '.lock')
+            self._log_file  = JavacServer._folder / (key + '.log')
+
+    # Return (<port>, <token>) or None if there is no port file.
+    def _read_port_file(self):
+        try:
+            port, token = self._port_file.read_text(encoding = 'utf-8').split()
+            return (int(port), token)
+        except (OSError, ValueError):
+            return None
+
+    def _connect(self):
+        server = self._read_port_file()
+        if server is None:
+            return None
+        try:
+            return (socket.create_connection(('127.0.0.1', server[0]), timeout = 10), server[1])
+        except OSError:
+            return None
+
+    # Connect to a running server or start a new one. The lock file
+    # serializes server startup between concurrent builds.
+    def _start(self):
+        JavacServer._folder.mkdir(parents = True, exist_ok = True)
+        with open(self._lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            connection = self._connect()
+            if connection is not None:
+                return connection
+
+            self._port_file.unlink(missing_ok = True)
+            print("Starting javac server", JavacServer._source, "(log: " + str(self._log_file) + ")")
+            with open(self._log_file, 'a') as log:
+                subprocess.Popen(
+                    [
+                        str(Path(self._java_home) / 'bin/java'),
+                        JavacServer._source,
+                        str(self._port_file),
+                        str(JavacServer._idle_timeout)
+                    ],
+                    stdin             = subprocess.DEVNULL,
+                    stdout            = log,
+                    stderr            = log,
+                    start_new_session = True
+                )
+
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                connection = self._connect()
+                if connection is not None:
+                    return connection
+                time.sleep(0.1)
+            raise OSError('Javac server failed to start', str(self._log_file))
+
+    def _read_reply(self, connection):
+        with connection.makefile('rb') as f:
+            header = f.readline().decode('utf-8').split()
+            if len(header) != 2:
+                raise OSError('Javac server closed connection')
+            code, length = int(header[0]), int(header[1])
+            output       = f.read(length)
+            if len(output) != length:
+                raise OSError('Javac server closed connection')
+        return code, output.decode('utf-8', errors = 'replace')
+
+    # Return the javac exit code, or None if the server is unavailable
+    # (the caller falls back to running javac).
+    def compile(self, options_file, sources_file):
+        if self._dead:
+            return None
+        try:
+            connection, token = self._start()
+            with connection:
+                connection.settimeout(None)
+                request = [ 'javac', token, os.getcwd(), '@' + options_file, '@' + sources_file ]
+                connection.sendall(('\t'.join(request) + '\n').encode('utf-8'))
+                code, output = self._read_reply(connection)
+        except (OSError, ValueError) as e:
+            print("Javac server unavailable, falling back to javac", e)
+            self._dead = True
+            return None
+        print(output, end = '')
+        if code == -1:
+            print("Javac server rejected request, falling back to javac")
+            self._dead = True
+            return None
+        return code
+
+def javac_fn(options_file, sources_file, server = None):
 
     with open(options_file, 'r') as f:
         print("Options")
         for line in f.readlines():
             print(line.strip())
 
+    if server is not None:
+        code = server.compile(options_file, sources_file)
+        if code is not None:
+            if code != 0:
+                raise subprocess.CalledProcessError(code, 'javac-server')
+            return
+
     #with open(sources_file, 'r') as f:
     #    print("Sources")
     #    for line in f.readlines():
@@ -38,7 +170,7 @@ def javac_fn(options_file, sources_file):
         check      = True
     )
 
-def compile(options, source_sets):
+def compile(options, source_sets, server = None):
     with tempfile.NamedTemporaryFile(delete_on_close=False) as options_file:
         for (option, value) in options:
             options_file.write(bytes(option + " " + str(value) + os.linesep, encoding='utf-8'))
@@ -51,14 +183,55 @@ def compile(options, source_sets):
                         sources_file.write(bytes(str(s) + os.linesep, encoding='utf-8'))
             sources_file.close()
 
-            javac_fn(options_file.name, sources_file.name)
+            javac_fn(options_file.name, sources_file.name, server)
+
+# Patterns use 'PurePath.match' semantics: a relative pattern matches
+# the trailing path components, each component like 'fnmatch' and '**'
+# like '*'. All include (exclude) patterns of a set are compiled into one
+# regular expression over the path with separators and newlines swapped
+# (like 'pathlib' does), so that '*' never matches a separator.
+_swap_sep_and_newline  = str.maketrans({ '/' : '\n', '\n' : '/' })
+_fnmatch_prefix, _fnmatch_suffix = fnmatch.translate('_').split('_')
+_fnmatch_slice         = slice(len(_fnmatch_prefix), -len(_fnmatch_suffix))
+
+def _compile_patterns(patterns):
+    if len(patterns) == 0:
+        return None
+    alternatives = []
+    for i, pattern in enumerate(patterns):
+        path = PurePath(pattern)
+        if str(path) == '.':
+            raise ValueError('Empty pattern', pattern)
+        parts = [ r'\A' if path.is_absolute() else '^' ]
+        for part in str(path).translate(_swap_sep_and_newline).splitlines(keepends = True):
+            if part == '*\n':
+                part = r'.+\n'
+            elif part == '*':
+                part = r'.+'
+            else:
+                part = fnmatch.translate(part)[_fnmatch_slice]
+            parts.append(part)
+        parts.append(r'\Z')
+        alternatives.append('(?P<p' + str(i) + '>' + ''.join(parts) + ')')
+    return re.compile('|'.join(alternatives), re.MULTILINE)
 
 class Files:
+    # { <folder> : ({ <dir> : <mtime_ns> }, [ (<dir>, [ <file> ]) ]) }
+    # Directory listings shared by all file sets of a build. A listing is
+    # reused while the modification times of all its directories are
+    # unchanged (files added, removed or renamed change the mtime of the
+    # directory containing them).
+    _walks   = dict()
+    # { (<folder>, <include>, <exclude>) : (<listing>, [ (<dir>, [ <file> ]) ]) }
+    _matches = dict()
+
     def __init__(self, folder, include, exclude, options = {}):
         self._src     = Path(folder)
         self._include = include or []
         self._exclude = exclude or []
         self._verbose = options['verbose'] if 'verbose' in options else False
+        self._include_re = _compile_patterns(self._include)
+        self._exclude_re = _compile_patterns(self._exclude)
 
     def include(folder, include, options = {}):
         return Files(folder, include, None, options)
@@ -69,32 +242,97 @@ class Files:
     def of(folder, include, exclude, options = {}):
         return Files(folder, include, exclude, options)
 
-    def match(self, path):
-        if self._exclude is not None:
-            for p in self._exclude:
-                if path.match(p):
-                    if self._verbose:
-                        print('Exclude', p, path)
-                    return False
-        if self._include is not None:
-            for p in self._include:
-                if path.match(p):
-                    if self._verbose:
-                        print('Include', p, path)
-                    return True
+    def _match_lines(self, lines, path):
+        if self._exclude_re is not None:
+            m = self._exclude_re.search(lines)
+            if m is not None:
+                if self._verbose:
+                    print('Exclude', self._exclude[int(m.lastgroup[1:])], path)
+                return False
+        if self._include_re is not None:
+            m = self._include_re.search(lines)
+            if m is not None:
+                if self._verbose:
+                    print('Include', self._include[int(m.lastgroup[1:])], path)
+                return True
         if self._verbose:
             print('Exclude (no pattern)', path)
         return False
 
+    # Return True if 'path' (relative to the folder) is in this set.
+    def match(self, path):
+        path = PurePath(path)
+        return self._match_lines('' if str(path) == '.' else str(path).translate(_swap_sep_and_newline), path)
+
+    # Return [ (<dir>, [ <file> ]) ] like 'os.walk' (top-down, directory
+    # order, symbolic links to directories not followed) with directories
+    # relative to the folder ('' for the folder itself).
+    def _walk(self):
+        top     = os.path.abspath(self._src)
+        listing = Files._walks.get(top)
+        if listing is not None:
+            try:
+                if all(os.stat(os.path.join(top, d)).st_mtime_ns == mtime for d, mtime in listing[0].items()):
+                    return listing
+            except OSError:
+                pass
+
+        mtimes  = dict()
+        entries = []
+        stack   = [ '' ]
+        while len(stack) > 0:
+            d = stack.pop()
+            try:
+                with os.scandir(os.path.join(top, d)) as it:
+                    dirs  = []
+                    files = []
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if not is_dir:
+                            files.append(entry.name)
+                        elif not entry.is_symlink():
+                            dirs.append(entry.name)
+                    mtimes[d] = os.stat(os.path.join(top, d)).st_mtime_ns
+            except OSError:
+                continue
+            entries.append((d, files))
+            stack.extend(reversed([ os.path.join(d, name) for name in dirs ]))
+
+        listing = (mtimes, entries)
+        if '' in mtimes:
+            Files._walks[top] = listing
+        return listing
+
+    # Return [ (<dir>, [ <file> ]) ] of files in this set.
+    def _matched(self):
+        listing = self._walk()
+        key     = (os.path.abspath(self._src), tuple(self._include), tuple(self._exclude))
+        cached  = Files._matches.get(key)
+        if cached is not None and cached[0] is listing and not self._verbose:
+            return cached[1]
+        result = []
+        for d, files in listing[1]:
+            prefix = d.translate(_swap_sep_and_newline) + '\n' if d != '' else ''
+            result.append((d, [
+                file for file in files
+                if self._match_lines(prefix + file.translate(_swap_sep_and_newline), PurePath(d) / file)
+            ]))
+        Files._matches[key] = (listing, result)
+        return result
+
     def __iter__(self):
         return (
-            (Path(d) / file for file in files if self.match(Path(d).relative_to(self._src) / file))
-            for d, dirs, files in os.walk(self._src)
+            (self._src / d / file for file in files)
+            for d, files in self._matched()
         )
 
 class Javac:
-    def __init__(self, target_version):
+    def __init__(self, target_version, server = None):
         self._target_version = target_version
+        self._server         = server
         self._classes        = None
         self._sources        = []
         self._classpath      = []
@@ -131,7 +369,385 @@ class Javac:
             cp = ':'.join(self._modulepath)
             options.append(('--module-path', cp))
 
-        compile(options, self._sources)
+        compile(options, self._sources, self._server)
+
+# Incremental compilation of the sources below 'src' into 'classes'.
+#
+# The state file records the digest of each source, the class files the
+# source produced, and the classes referenced from those class files
+# (see 'classfile.py'). Changed and removed sources are recompiled with
+# their transitive dependents into the existing 'classes' folder, and
+# their previous class files are deleted. Everything is recompiled if
+# there is no valid state (options or classpath changed, class files
+# missing), or if a changed source changes a compile-time constant,
+# which javac inlines into dependents.
+class IncrementalJavac:
+    def __init__(self, javac, src, classes, state_file):
+        self._javac      = javac
+        self._src        = Path(src)
+        self._classes    = Path(classes)
+        self._state_file = Path(state_file)
+        self._state      = None
+
+    # Key of everything but the sources that affects the compiled classes.
+    def _key(self):
+        entries = []
+        for entry in self._javac._classpath + self._javac._modulepath:
+            if os.path.exists(entry):
+                st = os.stat(entry)
+                entries.append([ entry, st.st_size, st.st_mtime_ns ])
+            else:
+                entries.append([ entry ])
+        return [ str(self._javac._target_version), os.environ.get('JAVA_HOME', ''), entries ]
+
+    def _digest(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+    # Load the state and remove everything but class files recorded in the
+    # state from 'classes' (resources are copied again before compiling).
+    # Start from an empty 'classes' folder if there is no valid state.
+    def prepare(self):
+        state = None
+        if self._state_file.exists():
+            with open(self._state_file, 'r') as f:
+                state = json.load(f)
+            os.remove(self._state_file) # Written again on success.
+            if state['key'] != self._key():
+                print("[incremental] Compiler options or classpath changed")
+                state = None
+        owned = set()
+        if not state is None:
+            owned = set([ c for entry in state['sources'].values() for c in entry['classes'] ])
+            if not all([ (self._classes / c).exists() for c in owned ]):
+                print("[incremental] Class files missing")
+                state = None
+        if state is None:
+            if self._classes.exists():
+                shutil.rmtree(self._classes)
+            self._classes.mkdir(parents = True)
+        else:
+            for d, dirs, files in os.walk(self._classes, topdown = False):
+                for file in files:
+                    path = Path(d) / file
+                    if not str(path.relative_to(self._classes)) in owned:
+                        os.remove(path)
+                if Path(d) != self._classes and len(os.listdir(d)) == 0:
+                    os.rmdir(d)
+        self._state = state
+
+    def _sources(self):
+        return {
+            str(path.relative_to(self._src)) : self._digest(path)
+            for g in Files.include(self._src, ['*.java'])
+            for path in g
+        }
+
+    # Return sources to recompile given changed (or added) and removed
+    # sources: changed sources, sources in packages of added sources
+    # (simple names may resolve differently), and the transitive
+    # dependents of classes of changed and removed sources.
+    def _dirty(self, sources, changed, removed):
+        state      = self._state['sources']
+        dependents = dict() # { <class name> : { <source> } }
+        for source, entry in state.items():
+            for name in entry['references']:
+                dependents.setdefault(name, set()).add(source)
+
+        dirty    = set(changed)
+        packages = set([ os.path.dirname(s) for s in changed if not s in state ])
+        dirty.update([ s for s in sources if os.path.dirname(s) in packages ])
+        names    = [ n for s in dirty | removed if s in state for n in state[s]['names'] ]
+        while len(names) > 0:
+            name = names.pop()
+            for source in dependents.get(name, []):
+                if not source in dirty and source in sources:
+                    dirty.add(source)
+                    names.extend(state[source]['names'])
+        return dirty
+
+    # Map class files (relative to 'classes') to sources using the class
+    # name and its 'SourceFile' attribute. Return None if a class file
+    # cannot be mapped to exactly one of the compiled sources.
+    def _record(self, class_files, compiled):
+        entries  = dict()
+        by_name  = dict() # { <file name> : [ <source> ] }
+        for source in compiled:
+            by_name.setdefault(os.path.basename(source), []).append(source)
+        for class_file in class_files:
+            cf     = ClassFile.load(self._classes / class_file)
+            source = None
+            if not cf.source_file is None:
+                candidate = os.path.join(os.path.dirname(cf.name), cf.source_file)
+                if candidate in compiled:
+                    source = candidate
+                elif len(by_name.get(cf.source_file, [])) == 1:
+                    source = by_name[cf.source_file][0]
+            if source is None:
+                print("[incremental] Cannot map class file to source", class_file)
+                return None
+            entry = entries.setdefault(source, { 'classes' : [], 'names' : [], 'references' : set(), 'constants' : dict() })
+            entry['classes'].append(class_file)
+            entry['names'].append(cf.name)
+            entry['references'].update(cf.references())
+            for field, value in cf.constants.items():
+                entry['constants'][cf.name + '.' + field] = value
+        return entries
+
+    def _class_files(self):
+        result = []
+        for d, dirs, files in os.walk(self._classes):
+            for file in files:
+                if file.endswith('.class'):
+                    result.append(str((Path(d) / file).relative_to(self._classes)))
+        return result
+
+    def _run_javac(self, sources, classpath):
+        javac = Javac(self._javac._target_version, self._javac._server)
+        javac.classes(str(self._classes))
+        javac.classpath(classpath + self._javac._classpath)
+        javac.modulepath(self._javac._modulepath)
+        javac.sources([ [ [ self._src / s for s in sorted(sources) ] ] ])
+        javac.compile()
+
+    def compile(self):
+        sources = self._sources()
+        state   = self._state
+
+        if state is None:
+            print("[incremental] Compiling all", len(sources), "sources")
+            self._run_javac(sources, [])
+            compiled = set(sources)
+            kept     = dict()
+        else:
+            changed = set([ s for s, digest in sources.items() if not s in state['sources'] or state['sources'][s]['digest'] != digest ])
+            removed = set(state['sources']) - set(sources)
+            dirty   = self._dirty(sources, changed, removed)
+            print("[incremental]", len(changed), "changed,", len(removed), "removed,", len(dirty), "to compile of", len(sources), "sources")
+            for source in dirty | removed:
+                if source in state['sources']:
+                    for class_file in state['sources'][source]['classes']:
+                        path = self._classes / class_file
+                        if path.exists():
+                            os.remove(path)
+            if len(dirty) > 0:
+                self._run_javac(dirty, [ str(self._classes) ])
+            compiled = dirty
+            kept     = { s : e for s, e in state['sources'].items() if s in sources and not s in dirty }
+
+        owned   = set([ c for entry in kept.values() for c in entry['classes'] ])
+        entries = self._record([ c for c in self._class_files() if not c in owned ], compiled)
+        if entries is None:
+            return # Without state, the next compile is a full compile.
+
+        if not state is None:
+            for source in (compiled & set(state['sources'])) | removed:
+                before = state['sources'][source]['constants']
+                after  = entries[source]['constants'] if source in entries else dict()
+                if before != after:
+                    print("[incremental] Compile-time constants changed in", source)
+                    for class_file in self._class_files():
+                        os.remove(self._classes / class_file)
+                    self._state = None
+                    return self.compile()
+
+        result = dict(kept)
+        for source in compiled:
+            entry = entries.get(source, { 'classes' : [], 'names' : [], 'references' : set(), 'constants' : dict() })
+            result[source] = {
+                'digest'     : sources[source],
+                'classes'    : sorted(entry['classes']),
+                'names'      : sorted(entry['names']),
+                'references' : sorted(entry['references'] - set(entry['names'])),
+                'constants'  : entry['constants']
+            }
+        with open(self._state_file, 'w') as f:
+            json.dump({ 'key' : self._key(), 'sources' : result }, f)
+
+# Compilation of the sources below 'src' in shards that run concurrently.
+#
+# Sources are grouped by package. Packages are connected by the imports
+# and qualified names in their sources, and packages in a cycle (strongly
+# connected component) form one group. Groups are compiled in waves in
+# topological order: groups of a wave only depend on groups of earlier
+# waves, which are on the classpath through 'classes'. Each wave is split
+# into at most 'jobs' shards of similar size, each compiled into a folder
+# of its own that is merged into 'classes' after the wave. If any shard
+# fails (e.g. because of a dependency missed by the source scan), all
+# class files are deleted and the sources are compiled by a single javac
+# run. Projects with a 'module-info.java' or a modulepath are always
+# compiled by a single javac run.
+class ShardedJavac:
+    _noise     = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|//[^\n]*|/\*.*?\*/', re.DOTALL)
+    _package   = re.compile(r'\bpackage\s+([\w.]+)\s*;')
+    _import    = re.compile(r'\bimport\s+(?:static\s+)?([\w.]+)(?:\s*\.\s*\*)?\s*;')
+    _qualified = re.compile(r'\b([a-z_]\w*(?:\s*\.\s*[a-z_]\w*)+)\s*\.\s*[A-Z]')
+
+    def __init__(self, javac, src, jobs):
+        self._javac = javac
+        self._src   = Path(src)
+        self._jobs  = jobs
+
+    # Return { <package> : [ <source path> ] }.
+    def _packages(self, sources):
+        packages = dict()
+        texts    = dict()
+        for source in sources:
+            with open(source, 'r', encoding = 'utf-8', errors = 'replace') as f:
+                text = ShardedJavac._noise.sub(' ', f.read())
+            match = ShardedJavac._package.search(text)
+            if match is not None:
+                package = match.group(1)
+            else:
+                package = '.'.join(source.parent.relative_to(self._src).parts)
+            packages.setdefault(package, []).append(source)
+            texts[source] = text
+        return packages, texts
+
+    # Return the package of qualified 'name' (a package, a class, or a
+    # member of a class) if it is one of 'packages'.
+    def _package_of(self, name, packages):
+        parts = name.replace(' ', '').split('.')
+        for n in range(len(parts), 0, -1):
+            package = '.'.join(parts[:n])
+            if package in packages:
+                return package
+        return None
+
+    # Return { <package> : set(<package>) } of dependencies between
+    # packages of this project.
+    def _package_graph(self, packages, texts):
+        graph = { package : set() for package in packages }
+        for package, sources in packages.items():
+            for source in sources:
+                names = ShardedJavac._import.findall(texts[source]) + ShardedJavac._qualified.findall(texts[source])
+                for name in names:
+                    dep = self._package_of(name, packages)
+                    if dep is not None and dep != package:
+                        graph[package].add(dep)
+        return graph
+
+    # Return strongly connected components of 'graph' (Tarjan), with
+    # dependencies before dependents.
+    def _components(self, graph):
+        index      = dict()
+        lowlink    = dict()
+        stack      = []
+        on_stack   = set()
+        components = []
+        for root in sorted(graph):
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            frames = [ (root, iter(sorted(graph[root]))) ]
+            while len(frames) > 0:
+                node, deps = frames[-1]
+                dep = next(deps, None)
+                if dep is not None:
+                    if not dep in index:
+                        index[dep] = lowlink[dep] = len(index)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        frames.append((dep, iter(sorted(graph[dep]))))
+                    elif dep in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dep])
+                    continue
+                frames.pop()
+                if len(frames) > 0:
+                    parent          = frames[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+        return components
+
+    # Return list of waves, each a list of shards (lists of sources).
+    def _waves(self, packages, graph):
+        components = self._components(graph)
+        component  = { package : i for i, members in enumerate(components) for package in members }
+        level      = []
+        for i, members in enumerate(components):
+            deps = set([ component[dep] for package in members for dep in graph[package] ]) - set([ i ])
+            level.append(1 + max([ level[dep] for dep in deps ], default = -1))
+
+        waves = []
+        for wave in range(max(level, default = -1) + 1):
+            groups = [
+                [ source for package in members for source in packages[package] ]
+                for i, members in enumerate(components) if level[i] == wave
+            ]
+            # Largest groups first into the smallest shard.
+            shards = [ [] for i in range(min(self._jobs, len(groups))) ]
+            for group in sorted(groups, key = len, reverse = True):
+                min(shards, key = len).extend(group)
+            waves.append(shards)
+        return waves
+
+    # Compile shard 'sources' into 'classes'. The classpath holds the
+    # classes of earlier waves only (see 'compile').
+    def _run_javac(self, sources, classes):
+        classes.mkdir(parents = True, exist_ok = True)
+        javac = Javac(self._javac._target_version, self._javac._server)
+        javac.classes(str(classes))
+        javac.classpath([ str(self._javac._classes) ] + self._javac._classpath)
+        javac.sources([ [ sorted(sources) ] ])
+        javac.compile()
+
+    # Move class files of shard output 'folder' into the classes folder.
+    def _merge(self, folder):
+        for d, dirs, files in os.walk(folder):
+            target = Path(self._javac._classes) / Path(d).relative_to(folder)
+            target.mkdir(parents = True, exist_ok = True)
+            for file in files:
+                os.replace(Path(d) / file, target / file)
+
+    def _compile_monolithic(self, sources):
+        javac = Javac(self._javac._target_version, self._javac._server)
+        javac.classes(str(self._javac._classes))
+        javac.classpath(self._javac._classpath)
+        javac.modulepath(self._javac._modulepath)
+        javac.sources([ [ sorted(sources) ] ])
+        javac.compile()
+
+    def compile(self):
+        sources = [ s for g in Files.include(self._src, ['*.java']) for s in g ]
+        if self._jobs < 2 or len(self._javac._modulepath) > 0 or any(s.name == 'module-info.java' for s in sources):
+            return self._compile_monolithic(sources)
+
+        packages, texts = self._packages(sources)
+        waves = self._waves(packages, self._package_graph(packages, texts))
+        print("[sharded]", len(sources), "sources,", len(packages), "packages,", len(waves), "waves")
+        # Shards of a wave write to folders of their own next to the
+        # classes folder, which are merged into it after the wave. Shards
+        # then never read classes written by other shards of the wave.
+        Path(self._javac._classes).mkdir(parents = True, exist_ok = True)
+        shard_root = Path(tempfile.mkdtemp(prefix = 'shards-', dir = Path(self._javac._classes).parent))
+        try:
+            with ThreadPoolExecutor(max_workers = self._jobs) as pool:
+                for i, shards in enumerate(waves):
+                    print("[sharded] Wave", i, [ len(shard) for shard in shards ])
+                    folders = [ shard_root / (str(i) + '-' + str(j)) for j in range(len(shards)) ]
+                    for future in [ pool.submit(self._run_javac, shard, folder) for shard, folder in zip(shards, folders) ]:
+                        future.result()
+                    for folder in folders:
+                        self._merge(folder)
+        except subprocess.CalledProcessError as e:
+            print("[sharded] Shard failed, compiling all sources in one javac run", e)
+            for d, dirs, files in os.walk(self._javac._classes):
+                for file in files:
+                    if file.endswith('.class'):
+                        os.remove(Path(d) / file)
+            self._compile_monolithic(sources)
+        finally:
+            shutil.rmtree(shard_root, ignore_errors = True)
 
 class Config:
 
@@ -197,6 +813,15 @@ class Config:
             return self.context.args.target_version
         return None
 
+    def incremental(self):
+        return self.context.args.incremental
+
+    def javac_server(self):
+        return self.context.args.javac_server
+
+    def javac_jobs(self):
+        return self.context.args.javac_jobs
+
 class BuildContext:
     def __init__(self, path, args):
         self.path = Path(path)
@@ -226,6 +851,11 @@ class Project:
         self.deployment          = None
         self._source_version     = 8
         self._target_version     = 8
+        # False if staging found 'build/' unchanged since the previous
+        # staging (see '_create_source_tree'), None before staging.
+        self.source_tree_changed = None
+        # Digest over the inputs of the source tree (see '_action_inputs').
+        self._source_digest      = None
 
         if not self.path.exists():
             raise ValueError('Project path does not exist', str(self.path))
@@ -265,7 +895,16 @@ class Project:
     def extend_runtime_classpath(self, entries):
         self._runtime_classpath.extend(entries)
 
-    def _copy_sources(self):
+    # Return files of 'gs' outside of 'build/'. File sets may include the
+    # project folder, and 'build/' is not removed before staging.
+    def _staged_files(self, gs):
+        build = os.path.abspath(self.path / 'build') + os.sep
+        for g in gs:
+            for src in g:
+                if not os.path.abspath(src).startswith(build):
+                    yield src
+
+    def _copy_sources(self, index):
         build     = self.path / 'build'
         main_java = build / 'src/main/java'
         test_java = build / 'src/test/java'
@@ -277,43 +916,51 @@ class Project:
             test_java.mkdir(parents = True)
  
         for gs in self._sources:
-            for g in gs:
-                for src in g:
-                    dst =  main_java / src.relative_to(gs._src)
-                    if not dst.parent.exists():
-                        dst.parent.mkdir(parents = True, exist_ok = True)
-                    #print("Copy", src, dst)
-                    shutil.copy2(src, dst)
-
-    def _copy_resources(self):
+            for src in self._staged_files(gs):
+                dst =  main_java / src.relative_to(gs._src)
+                #print("Copy", src, dst)
+                index.stage(src, dst)
+
+    def _copy_resources(self, index):
+        # Resources are packaged from 'build/src/main/resources' (see
+        # '_package'). They are not copied into 'build/dist'.
         targets = [
-            Path('build/dist'),
             Path('build/src/main/resources')
         ]
         for gs in self._resources:
-            for g in gs:
-                for src in g:
-                    for target in targets:
-                        dst = self.path / target / src.relative_to(gs._src)
-                        if not dst.parent.exists():
-                            dst.parent.mkdir(parents = True, exist_ok = True)
-                        #print("Copy", src, dst)
-                        shutil.copy2(src, dst)
+            for src in self._staged_files(gs):
+                for target in targets:
+                    dst = self.path / target / src.relative_to(gs._src)
+                    #print("Copy", src, dst)
+                    index.stage(src, dst)
 
         for (dst, gs) in self._resources_copy_to:
-            for g in gs:
-                for src in g:
-                    dst = dst / src.relative_to(gs._src)
-                    if not dst.parent.exists():
-                        dst.parent.mkdir(parents = True, exist_ok = True)
-                    #print("Copy to", src, dst)
-                    shutil.copy2(src, dst)
+            for src in self._staged_files(gs):
+                #print("Copy to", src, dst)
+                index.stage(src, dst / src.relative_to(gs._src))
+
+    # Delete files in 'build/' not in 'tracked' (paths relative to the
+    # project) for which 'keep' is False (class files, state and generated
+    # files of a previous build).
+    def _remove_untracked(self, tracked, keep = lambda path: False):
+        build   = self.path / 'build'
+        removed = set()
+        for d, dirs, files in os.walk(build, topdown = False):
+            for file in files:
+                path = Path(d) / file
+                if not str(path.relative_to(self.path)) in tracked and not keep(path):
+                    os.remove(path)
+                    removed.add(d)
+            if d in removed and Path(d) != build and len(os.listdir(d)) == 0:
+                os.rmdir(d)
+                removed.add(os.path.dirname(d))
 
     def classpath_attribute_value(self):
         rcp = [ str(Path(e).relative_to(Path(os.getcwd()))) for e in self._runtime_classpath ]
         cp  = ' '.join(rcp)
         return cp
 
+    # Return True if the manifest was written (changed).
     def _write_manifest(self, mfpath):
         # Select specified manifest or from file if changes exists.
         manifest = self.manifest if not self.manifest is None else (
@@ -324,9 +971,15 @@ class Project:
         if not manifest is None:
             if not self.manifest_changes is None:
                 manifest.update(self.manifest_changes)
+            if mfpath.exists() and mfpath.read_bytes() == manifest.encoded():
+                return False
             if not mfpath.parent.exists():
                 mfpath.parent.mkdir(parents = True)
+            if mfpath.exists():
+                os.remove(mfpath) # May be a staged (linked) resource.
             manifest.store(mfpath)
+            return True
+        return False
 
 
     # Assemble 'build/' or deploy from zip.
@@ -339,29 +992,98 @@ class Project:
     #   src/{main,test}/java/
     #   src/{main,test}/resources/
     #   dist/
+    #
+    # 'build/' is staged from the project files on every build. Only
+    # changed files are copied (see 'staging.SnapshotIndex'). The index
+    # in 'var/stage-index.json' is kept by 'clean'.
+    #
+    # The source tree (the staged 'build/' before compilation) is kept in
+    # a content-addressed store in 'var/tree/' (see 'staging.TreeStore'),
+    # from which 'build.zip' is written on export. A 'build.zip' newer
+    # than the store replaces the staged source tree. It is used (reused
+    # or restored from the store) until the next 'clean'.
     def _create_source_tree(self):
         build_zip       = self.path / 'build.zip'
         build           = self.path / 'build'
         import_location = self.config().import_location()
+        store           = TreeStore(self.path / 'var/tree')
 
-        if build.exists():
-            shutil.rmtree(build)
+        importing       = not import_location is None and (import_location / self.export_name()).exists()
+        tree            = store.load() if not importing else None
+        unzipping       = not importing and build_zip.exists() and (tree is None or os.stat(build_zip).st_mtime_ns > store.mtime_ns())
+        from_zip        = not importing and not unzipping and not tree is None and tree.get('origin') == 'zip'
+        staging         = not importing and not unzipping and not from_zip
 
-        if not import_location is None and (import_location / self.export_name()).exists():
-            build.mkdir()
+        # Keep compiled classes and state (see 'IncrementalJavac').
+        if self.config().incremental():
+            keep = lambda path: path.name == 'javac-state.json' or build / 'dist' in path.parents
+        else:
+            keep = lambda path: False
+
+        if from_zip and build.exists() and store.matches(build, tree):
+            print("Reusing source tree", build)
+            self._remove_untracked(set([ str(Path('build') / path) for path in tree['files'] ]), keep)
+            self.source_tree_changed = False
+            self._source_digest      = self._tree_digest(tree)
+            return
+
+        if build.exists() and not staging:
+            if self.config().incremental():
+                for path in build.iterdir():
+                    if path.name in ['dist', 'javac-state.json']:
+                        continue
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            else:
+                shutil.rmtree(build)
+
+        if importing:
+            build.mkdir(exist_ok = True)
             p = tools.unzip(import_location / self.export_name(), build)
             print("Unzipped to", p)
-        elif not build_zip.exists():
-            print("Create build.zip")
-            self._copy_sources()
-            self._copy_resources()
+            self.source_tree_changed = True
+        elif staging:
+            print("Stage source tree", build)
+            # Copy only changed files into 'build/' (see 'staging.py'). Files
+            # of a previous build that are not staged are deleted, so that
+            # 'build/' holds the same files as after a full copy.
+            mfpath = build / 'src/main/resources/META-INF/MANIFEST.MF'
+            index  = SnapshotIndex(self.path / 'var/stage-index.json', self.path)
+            self._copy_sources(index)
+            self._copy_resources(index)
+            index.finish()
             # TODO: Should we really do this here? Not instead when compiling?
-            self._write_manifest(build / 'src/main/resources/META-INF/MANIFEST.MF')
-            tools.zip(build, build_zip)
-        else:
-            build.mkdir()
+            written = self._write_manifest(mfpath)
+            self._remove_untracked(index, lambda path: keep(path) or path == mfpath)
+            self.source_tree_changed = index.changed or written
+            if self.source_tree_changed or tree is None:
+                store.record(build, keep)
+            # The staged files and the manifest, as staged by this build.
+            self._source_digest = [ 'stage', build_cache.action_key([
+                index.digests(),
+                build_cache.file_digest(mfpath) if mfpath.exists() else None
+            ]) ]
+        elif unzipping:
+            build.mkdir(exist_ok = True)
             p = tools.unzip(build_zip, build)
             print("Unzipped to", p)
+            tree = store.record(build, keep, 'zip')
+            self.source_tree_changed = True
+            self._source_digest      = self._tree_digest(tree)
+        else:
+            print("Restoring source tree", build)
+            build.mkdir(exist_ok = True)
+            store.materialize(build, tree)
+            self.source_tree_changed = True
+            self._source_digest      = self._tree_digest(tree)
+
+    def _tree_digest(self, tree):
+        return [ 'tree', build_cache.action_key([
+            sorted([ [ path, entry[0] ] for path, entry in tree['files'].items() ]),
+            tree['dirs']
+        ]) ]
 
     def _create_binary_tree(self):
         build = self.path / 'build'
@@ -370,54 +1092,116 @@ class Project:
         if not dist.exists():
             dist.mkdir(parents = True)
 
-        # TODO: Copy resources from 'build/src/{main,test}/resources'
         # TODO: Need test resource declarations (conf specific actions)
 
-        # The goal here is to copy resources that should be packaged into the jar.
+        # Resources are not copied into 'dist'. The jar is written from
+        # 'dist' and 'build/src/main/resources' (see '_package').
         # Deployment data is handled in the deployment function.
 
-        _src = build / 'src/main/resources'
-        for g in Files.include(_src, include = ['*']):
-            for src in g:
-                dst = dist / src.relative_to(_src)
-                if not dst.parent.exists():
-                    dst.parent.mkdir(parents = True, exist_ok = True)
-                #print("Copy (binary resources)", src, dst)
-                shutil.copy2(src, dst)
-
     def _compile(self):
-        self._create_source_tree()
-        self._create_binary_tree()
-
         build     = self.path / 'build'
         dist      = build / 'dist'
         main_java = build / 'src/main/java'
 
-        javac = Javac(self.config().target_version())
-        javac.sources([ Files.include(main_java, ['*.java']) ])
+        javac = Javac(
+            self.config().target_version(),
+            JavacServer.instance() if self.config().javac_server() else None
+        )
         javac.classes(str(dist))
         javac.classpath(self._compile_classpath)
         javac.modulepath(self._compile_modulepath)
+
+        if self.config().incremental():
+            incremental = IncrementalJavac(javac, main_java, dist, build / 'javac-state.json')
+            incremental.prepare()
+            self._create_binary_tree()
+            incremental.compile()
+            return
+
+        self._create_binary_tree()
+
+        if self.config().javac_jobs() > 1:
+            ShardedJavac(javac, main_java, self.config().javac_jobs()).compile()
+            return
+
+        javac.sources([ Files.include(main_java, ['*.java']) ])
         javac.compile()
 
+    # Return { <jar entry name> : <path> } of files below 'folder'.
+    def _jar_entries(self, folder):
+        entries = dict()
+        for g in Files.include(folder, ['*']):
+            for path in g:
+                entries['/'.join(path.relative_to(folder).parts)] = path
+        return entries
+
+    # Write the jar from the javac output and the resources of the source
+    # tree, which take precedence (like resources copied over 'dist').
+    # The manifest is the one in the resources (see '_write_manifest'),
+    # or the project manifest if the resources have none.
+    # The source tree is expected to be created (see '_deploy').
     def _package(self, artifact):
         self._compile()
-        jar_src = self.path / 'build/dist'
-        jar_dst = artifact
-        tools.jar(jar_src, jar_dst)
+        build   = self.path / 'build'
+        entries = self._jar_entries(build / 'dist')
+        entries.update(self._jar_entries(build / 'src/main/resources'))
 
+        manifest = entries.pop('META-INF/MANIFEST.MF', None)
+        if not manifest is None:
+            with open(manifest, 'rb') as f:
+                manifest = f.read()
+        elif not self.manifest is None:
+            manifest = self.manifest.encoded()
+
+        tools.write_jar(artifact, manifest, entries)
+
+    # Return the inputs of packaging the project (see 'build_cache.py'):
+    # the sources, resources and manifest staged by this build (or the
+    # tree from 'build.zip', or the imported patch), the compile classpath
+    # and modulepath jars, the javac options and the JDK.
+    def _action_inputs(self, patch):
+        if not patch is None:
+            sources = [ 'import', build_cache.file_digest(patch) ]
+        else:
+            sources = self._source_digest
+        java_home = os.environ.get('JAVA_HOME')
+        return {
+            'artifact'   : self.artifact(),
+            'sources'    : sources,
+            'classpath'  : [ [ Path(e).name, build_cache.path_digest(e) ] for e in self._compile_classpath ],
+            'modulepath' : [ [ Path(e).name, build_cache.path_digest(e) ] for e in self._compile_modulepath ],
+            'target'     : self.config().target_version(),
+            'javac'      : build_cache.javac_version(java_home)
+        }
+
+    # The artifact is reused from the action cache in 'var/actions/' if
+    # the source tree, classpath, javac options and JDK are unchanged
+    # since it was packaged (see 'build_cache.ActionCache'), or pulled
+    # from the shared cache if there is one (see 'build_cache.set_remote').
+    # Packaged artifacts are pushed to the shared cache.
     def _deploy(self):
-        artifact        = None
+        patch           = None
         import_location = self.config().import_location()
         if not import_location is None and (import_location / self.export_name()).exists():
-            patch      = import_location / self.export_name()
-            patch_hash = tools.digest(patch, 'md5')
-            artifact   = self.path / 'var' / patch_hash / self.artifact()
-        else:
-            artifact = self.path / 'var' / self.artifact()
+            patch = import_location / self.export_name()
+
+        self._create_source_tree()
 
-        if not artifact.exists():
-            self._package(artifact)
+        cache    = ActionCache(self.path / 'var/actions')
+        inputs   = self._action_inputs(patch)
+        key      = build_cache.action_key(inputs)
+        artifact = cache.output(key, self.artifact())
+        if cache.contains(key):
+            print("[actions] Reusing", artifact)
+        else:
+            cache.begin(key)
+            if build_cache.pull(key, artifact.name, artifact):
+                cache.commit(key, inputs)
+            else:
+                print("[actions] Packaging", artifact)
+                self._package(artifact)
+                cache.commit(key, inputs)
+                build_cache.push(key, artifact)
 
         self._update_build_cache(artifact)
 
@@ -430,10 +1214,13 @@ class Project:
         # We assume that all modules have already been pulled from providers.
         jars  = ivy.cache().location(self.id) / 'jars'
         jar   = jars / artifact.name
+        if jar.exists() and build_cache.file_digest(jar) == build_cache.file_digest(artifact):
+            print("Build cache up to date", jar)
+            return
         print("Update build cache", jar, "<=", artifact)
         if not jars.exists():
             jars.mkdir()
-        shutil.copy2(artifact, jar)
+        staging.copy(artifact, jar)
 
     def build(self, clean):
         if clean:
@@ -445,7 +1232,15 @@ class Project:
         build     = self.path / 'build'
         build_zip = self.path / 'build.zip'
         if var.exists():
-            shutil.rmtree(var)
+            # Keep the staging index (see '_create_source_tree'). Files
+            # it records are copied again since 'build/' is removed.
+            for path in var.iterdir():
+                if path.name == 'stage-index.json':
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
         if build.exists():
             shutil.rmtree(build)
         if build_zip.exists():
@@ -459,6 +1254,16 @@ class Project:
             raise ValueError("Expected directory")
         src = self.path / 'build.zip'
         dst = folder / self.export_name()
+        store = TreeStore(self.path / 'var/tree')
+        tree  = store.load()
+        if tree is None and not src.exists():
+            raise ValueError('No source tree to export. Build the project first', str(self.path))
+        # Write 'build.zip' unless it is up to date or the origin of the tree.
+        if not src.exists() or (not tree is None and tree.get('origin') != 'zip' and os.stat(src).st_mtime_ns < store.mtime_ns()):
+            print("Create", src)
+            store.write_zip(tree, src)
+            # Not newer than the store (see '_create_source_tree').
+            os.utime(src, ns = (store.mtime_ns(), store.mtime_ns()))
         print("Copy", src, dst)
         shutil.copy2(src, dst)
 
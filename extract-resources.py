@@ -1,5 +1,6 @@
 #!/bin/env python3
 
+import argparse
 import copy
 import hashlib
 import os
@@ -106,7 +107,7 @@ def install_benchmark_module(name, dependencies):
     #    })
     bp.dep(ivy.ID('dacapo', 'harness', '1.0'), {
         'force': 'true',
-        'conf' : 'compile->master(*);runtime->master(*),runtime(*)'
+        'conf' : 'compile->master(*),compile(*);runtime->master(*),runtime(*)'
     })
     for dep_id, dep_attrib in dependencies:
         bp.dep(dep_id, dep_attrib)
@@ -214,10 +215,10 @@ def extract_bm_jacop():
 
 def extract_harness():
 
-    # The harness is injected into the build of benchmarks
-    # and is therefore not an independent project. We can
-    # still resolve its dependencies via ivy by adding
-    # an interface module.
+    # The harness is built as a project of its own (see
+    # 'harness_1_0' in 'build.py') and published as the
+    # artifact of module 'dacapo:harness:1.0', on which all
+    # benchmarks depend.
 
     # Dacapo (Harness)
 
@@ -231,10 +232,15 @@ def extract_harness():
     dst_harness = Path('dacapo/harness')
     shutil.copytree(src_harness, dst_harness, dirs_exist_ok = True)
 
+    # Project folder (build output) of the harness. Sources stay in
+    # 'dacapo/'.
+    Path('projects/harness-1.0').mkdir(parents = True, exist_ok = True)
+
     id  = ivy.ID('dacapo', 'harness', '1.0')
     bp  = ivy.blueprint()
     bp.id(id)
-    bp.artifact(None) # Delete default artifact (interface module).
+    bp.artifact({ 'name' : 'harness', 'type' : "jar", 'ext' : "jar", 'conf' : "master" })
+    bp.conf({'name': 'master'})
     bp.conf({'name': 'compile'})
     bp.conf({'name': 'runtime', 'extends': 'compile'})
     dependencies = [
@@ -271,5 +277,14 @@ def extract_resources():
     #extract_xerces.extract_lib_xerces()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offline', required = False, action = "store_true",
+        help = "Use files in 'downloads/' and 'ivy-cache/' only")
+    args = parser.parse_args()
+
+    if args.offline:
+        ivy.set_offline(True)
+        tools.set_offline(True)
+
     extract_resources()
 
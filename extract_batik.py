@@ -4,10 +4,15 @@ import shutil
 import ivy_cache_resolver as ivy
 import tools
 
+# Source archive (url, file, md5) fetched into 'downloads/'.
+source_archive = (
+    'https://archive.apache.org/dist/xmlgraphics/batik/source/batik-src-1.16.zip',
+    'batik-src-1.16.zip',
+    'b40dedda815115a98aa334d90c6c312c'
+)
+
 def extract_lib_batik():
-    url = 'https://archive.apache.org/dist/xmlgraphics/batik/source'
-    src = 'batik-src-1.16.zip'
-    md5 = 'b40dedda815115a98aa334d90c6c312c'
+    url, src, md5 = source_archive
 
     # Download and unpack into build
 
@@ -16,7 +21,7 @@ def extract_lib_batik():
     if not build.exists():
         build.mkdir()
 
-    source = tools.fetch(url + '/' + src, src, md5)
+    source = tools.fetch(url, src, md5)
     root   = tools.unzip(source, build)
 
     # Extract resources from source tree
@@ -52,11 +52,16 @@ def install_dependencies():
 
     ivy.ResolverModule.add_module(bp.build())
 
+# Source archive (url, file, md5) fetched into 'downloads/'.
+source_archive = (
+    'https://github.com/radsz/jacop/archive/refs/tags/4.10.0.zip',
+    #'https://github.com/radsz/jacop/archive/refs/tags/4.10.0.tar.gz',
+    'jacop-4.10.0.zip',
+    '8d5438dae2581540d7431799d6934bb8'
+)
+
 def extract_lib_jacop():
-    url = 'https://github.com/radsz/jacop/archive/refs/tags/4.10.0.zip'
-    #url = 'https://github.com/radsz/jacop/archive/refs/tags/4.10.0.tar.gz'
-    src = 'jacop-4.10.0.zip'
-    md5 = '8d5438dae2581540d7431799d6934bb8'
+    url, src, md5 = source_archive
 
     build = Path('build')
 
@@ -5,10 +5,15 @@ import tools
 import ivy_cache_resolver as ivy
 
 
+# Source archive (url, file, md5) fetched into 'downloads/'.
+source_archive = (
+    'https://archive.apache.org/dist/lucene/java/9.10.0/lucene-9.10.0-src.tgz',
+    'lucene-9.10.0-src.tgz',
+    '1d8b8bcc374c1aeb77de1da7393352cc'
+)
+
 def extract_lib_lucene():
-    url = 'https://archive.apache.org/dist/lucene/java/9.10.0'
-    src = 'lucene-9.10.0-src.tgz'
-    md5 = '1d8b8bcc374c1aeb77de1da7393352cc'
+    url, src, md5 = source_archive
 
     # Download and unpack into build
 
@@ -17,7 +22,7 @@ def extract_lib_lucene():
     if not build.exists():
         build.mkdir()
 
-    source = tools.fetch(url + '/' + src, src, md5)
+    source = tools.fetch(url, src, md5)
     root   = tools.untar(source, build)
 
     mods = [
@@ -4,10 +4,15 @@ import shutil
 import ivy_cache_resolver as ivy
 import tools
 
+# Source archive (url, file, md5) fetched into 'downloads/'.
+source_archive = (
+    'https://archive.apache.org/dist/xalan/xalan-j/source/xalan-j_2_7_2-src.tar.gz',
+    'xalan-j_2_7_2-src.tar.gz',
+    '74e6ab12dda778a4b26da67438880736'
+)
+
 def extract_lib_xalan():
-    url = 'https://archive.apache.org/dist/xalan/xalan-j/source'
-    src = 'xalan-j_2_7_2-src.tar.gz'
-    md5 = '74e6ab12dda778a4b26da67438880736'
+    url, src, md5 = source_archive
 
     # Download and unpack into build
 
@@ -16,7 +21,7 @@ def extract_lib_xalan():
     if not build.exists():
         build.mkdir()
 
-    source = tools.fetch(url + '/' + src, src, md5)
+    source = tools.fetch(url, src, md5)
     root   = tools.untar(source, build) / 'xalan-j_2_7_2'
 
     ivy_cache = ivy.Cache()
@@ -1,22 +1,30 @@
 #!/bin/env python3
 
 import argparse
+from array import array
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
 from pathlib import Path
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import xml.etree.ElementTree as ET
 
 class ResolverModule:
     _resources = Path('ivy-daivy-resolver-cache')
+    _changes   = 0 # Number of modules added (see 'Cache._shared_inputs_digest').
 
     # Add specified module to 'daivy' resolver.
     def add_module(module):
         tree = ET.ElementTree(module.load_xml())
         path = ResolverModule(module.id, clear = True).ivy_xml_path
         tree.write(path)
+        ResolverModule._changes = ResolverModule._changes + 1
 
         print("Installing locally provided ivy file", str(path))
 
@@ -54,22 +62,44 @@ class ResolverModule:
 def install_local_module(module):
     ResolverModule.add_module(module)
 
+# Module identifiers are interned: constructing an ID for a known
+# coordinate returns the existing instance. IDs compare and hash by
+# value and are used as dictionary keys throughout.
 class ID:
-    def __init__(self, org, mod, rev):
-        self.org    = org
-        self.mod    = mod
-        self.rev    = rev
-        self._key   = None
-        self._coord = None
+    __slots__ = ('org', 'mod', 'rev', '_key', '_coord')
+    _interned = dict() # { (<org>, <mod>, <rev>) : <ID> }
+
+    def __new__(cls, org, mod, rev):
+        key = (org, mod, rev)
+        id  = ID._interned.get(key)
+        if id is None:
+            id        = super().__new__(cls)
+            id.org    = org
+            id.mod    = mod
+            id.rev    = rev
+            id._key   = key
+            id._coord = None
+            id        = ID._interned.setdefault(key, id)
+        return id
+
+    def __getnewargs__(self):
+        return self._key
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, ID) and self._key == other._key)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return 'ID' + repr(self._key)
 
     def key(self):
-        if self._key is None:
-            self._key = (self.org, self.mod, self.rev)
         return self._key
 
     def coord(self):
         if self._coord is None:
-            self._coord = ":".join(self.key())
+            self._coord = ":".join(self._key)
         return self._coord
 
     def from_coord(coord):
@@ -89,6 +119,19 @@ class IvyXMLQueries:
             info.get('revision')
         )
 
+    # Return list of IDs of declared dependencies.
+    def dependencies(root):
+        dependencies_xml = root.find('dependencies')
+        dependencies     = []
+        if dependencies_xml is not None:
+            for dependency_xml in dependencies_xml.findall('dependency'):
+                d_org     = dependency_xml.get('org')
+                d_name    = dependency_xml.get('name')
+                d_rev     = dependency_xml.get('rev')
+                d_id      = ID(d_org, d_name, d_rev)
+                dependencies.append(d_id)
+        return dependencies
+
     def artifacts(root):
         id = IvyXMLQueries.id(root)
         xs = root.findall('.//artifact')
@@ -108,6 +151,10 @@ class XMLLoader:
     def load_xml(self):
         raise ValueError('unimplemented')
 
+    # Drop the parsed module definition if it can be loaded again.
+    def release(self):
+        pass
+
 class XMLFileLoader(XMLLoader):
     def __init__(self, path, root = None):
         super().__init__(root)
@@ -118,6 +165,9 @@ class XMLFileLoader(XMLLoader):
             self._root = ET.parse(self.path).getroot()
         return self._root
 
+    def release(self):
+        self._root = None
+
 class XMLTextLoader(XMLLoader):
     def __init__(self, text, root):
         super().__init__(root)
@@ -151,16 +201,9 @@ class Module:
 
     # Return list of IDs of declared dependencies.
     def declared_dependencies(self):
-        dependencies_xml = self.load_xml().find('dependencies')
-        dependencies     = []
-        if dependencies_xml is not None:
-            for dependency_xml in dependencies_xml.findall('dependency'):
-                d_org     = dependency_xml.get('org')
-                d_name    = dependency_xml.get('name')
-                d_rev     = dependency_xml.get('rev')
-                d_id      = ID(d_org, d_name, d_rev)
-                dependencies.append(d_id)
-        return dependencies
+        if not self._cache is None and self.id in self._cache._graph:
+            return self._cache._graph.dependencies(self.id)
+        return IvyXMLQueries.dependencies(self.load_xml())
 
     def blueprint(self):
         return ModuleBlueprint.from_module(self)
@@ -257,14 +300,674 @@ class ModuleBlueprint:
 class CacheConstants:
     _default_cache_name = 'ivy-cache'
     _default_cache      = None
+    _ivy_jar            = 'tools/ivy-2.5.2.jar'
+    _ivy_settings       = 'settings/ivysettings.xml' # Use custom settings to add the local 'daivy' resolver.
+    _ivy_server         = 'tools/ivy-server/IvyServer.java'
+    _settings_dir       = Path('settings')
+    _daivy_dir          = '.daivy' # Daivy state stored inside the ivy cache.
+    _offline            = False    # Default for new caches (see 'set_offline()').
+
+# Default ivy backend.
+# Start one ivy JVM per request.
+class IvyProcess:
+    def __init__(self, cachepath):
+        self._cachepath = cachepath
+        self._offline   = False
+
+    # Resolve from the cache only ('-useCacheOnly').
+    def set_offline(self, offline):
+        self._offline = offline
+
+    def _run(self, args):
+        cmd = " ".join([
+            "java",
+            "-jar",
+            CacheConstants._ivy_jar,
+            "-warn",
+            "-settings",
+            CacheConstants._ivy_settings,
+            "-cache",
+            self._cachepath
+        ] + (["-useCacheOnly"] if self._offline else []) + args)
+        subprocess.run(
+            cmd,
+            shell      = True,
+            executable = '/bin/bash'
+        )
+
+    # Resolve specified module into the cache.
+    def dependency(self, id):
+        self._run([
+            "-dependency",
+            id.org,
+            id.mod,
+            id.rev
+        ])
+
+    # Resolve specified module and write its classpath for
+    # specified configurations into the file at 'path'.
+    def cachepath(self, id, confs, types, path):
+        self._run([
+            "-types"
+        ] + types + [
+            "-dependency",
+            id.org,
+            id.mod,
+            id.rev,
+            "-cachepath",
+            path,
+            "-confs",
+            " ".join(confs)
+        ])
+
+    # Resolve specified configurations of an 'ivy.xml' file.
+    # Resolve reports are written into the cache.
+    def resolve(self, ivy_xml, confs, types):
+        self._run([
+            "-types"
+        ] + types + [
+            "-ivy",
+            ivy_xml,
+            "-confs"
+        ] + confs)
+
+    def close(self):
+        pass
+
+# Opt-in ivy backend.
+# Keep one ivy JVM running for the lifetime of the cache and send requests
+# to it over a pipe (see 'tools/ivy-server/IvyServer.java'). Settings are
+# loaded once, and there is no JVM startup cost per request. Requests are
+# delegated to the fallback backend if the worker dies or fails to start.
+class IvyDaemon:
+    def __init__(self, cachepath, fallback):
+        self._cachepath = cachepath
+        self._fallback  = fallback
+        self._process   = None
+        self._dead      = False
+        self._offline   = False
+        self._lock      = threading.Lock()
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    # Forked build workers (see 'build.py --jobs') must not share the
+    # pipes of the parent worker. Each child starts its own worker on
+    # first use. The worker exits when the child closes its stdin.
+    def _after_fork(self):
+        self._process = None
+        self._lock    = threading.Lock()
+
+    # Resolve from the cache only. Applies to a worker started after the call.
+    def set_offline(self, offline):
+        self._offline = offline
+        self._fallback.set_offline(offline)
+
+    def _start(self):
+        print("Starting ivy daemon", CacheConstants._ivy_server)
+        self._process = subprocess.Popen(
+            [
+                "java",
+                "-cp",
+                CacheConstants._ivy_jar,
+                CacheConstants._ivy_server,
+                CacheConstants._ivy_settings,
+                self._cachepath
+            ] + (["offline"] if self._offline else []),
+            stdin    = subprocess.PIPE,
+            stdout   = subprocess.PIPE,
+            text     = True,
+            encoding = 'utf-8',
+            bufsize  = 1
+        )
+        if self._process.stdout.readline().strip() != 'ready':
+            raise OSError('Ivy daemon failed to start')
+
+    def _stop(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.write('quit\n')
+            self._process.stdin.close()
+            self._process.wait(timeout = 10)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            self._process.kill()
+        self._process = None
+
+    # Return True if the request was handled by the daemon.
+    def _request(self, fields):
+        with self._lock:
+            if self._dead:
+                return False
+            try:
+                if self._process is None:
+                    self._start()
+                self._process.stdin.write('\t'.join(fields) + '\n')
+                self._process.stdin.flush()
+                reply = self._process.stdout.readline()
+                if reply == '':
+                    raise OSError('Ivy daemon exited', self._process.poll())
+            except (OSError, ValueError) as e:
+                print("Ivy daemon unavailable, falling back to", type(self._fallback).__name__, e)
+                self._dead = True
+                if self._process is not None:
+                    self._process.kill()
+                    self._process = None
+                return False
+            reply = reply.rstrip('\n').split('\t', 1)
+            if reply[0] != 'ok':
+                # Report and continue like the ivy command line would.
+                print("[ivy daemon]", ' '.join(fields[:4]), reply[1] if len(reply) > 1 else reply[0])
+            return True
+
+    def dependency(self, id):
+        if not self._request(['dependency', id.org, id.mod, id.rev, 'jar,bundle']):
+            self._fallback.dependency(id)
+
+    def cachepath(self, id, confs, types, path):
+        if not self._request(['cachepath', id.org, id.mod, id.rev, ','.join(confs), ','.join(types), path]):
+            self._fallback.cachepath(id, confs, types, path)
+
+    def resolve(self, ivy_xml, confs, types):
+        if not self._request(['resolve', ivy_xml, ','.join(confs), ','.join(types)]):
+            self._fallback.resolve(ivy_xml, confs, types)
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+# Raised by 'ConfigurationEngine' when a classpath cannot be computed
+# from the ivy cache alone. Callers fall back to ivy.
+class EngineMiss(Exception):
+    pass
+
+# Split on commas that are not enclosed in parentheses.
+# Example: 'master(*),runtime(a,b)' => ['master(*)', 'runtime(a,b)']
+def _split_conf_list(text):
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(text):
+        if c == '(':
+            depth = depth + 1
+        elif c == ')':
+            depth = depth - 1
+        elif c == ',' and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return [ p for p in parts if p != '' ]
+
+def _is_dynamic_revision(rev):
+    return rev is None or rev.startswith('latest.') or any(c in rev for c in '[]()+')
+
+# Configurations, publications and dependencies declared in an 'ivy.xml'
+# file, as used by 'ConfigurationEngine'. Raise 'EngineMiss' for features
+# that are not supported (configuration includes, global excludes,
+# overrides, conflict managers, dynamic revisions, artifact selection).
+class IvyDescriptor:
+    _maven_classifier = '{http://ant.apache.org/ivy/maven}classifier'
+
+    def __init__(self, root):
+        self.id   = IvyXMLQueries.id(root)
+        confs_xml = root.find('configurations')
+        deps_xml  = root.find('dependencies')
+        pubs_xml  = root.find('publications')
+
+        self.confs = dict() # { <name> : (<public>, [ <extends> ], <transitive>) }
+        if confs_xml is not None and confs_xml.find('include') is not None:
+            raise EngineMiss('Configuration includes are not supported', self.id.coord())
+        for c in ([] if confs_xml is None else confs_xml.findall('conf')):
+            self.confs[c.get('name')] = (
+                c.get('visibility', 'public') == 'public',
+                _split_conf_list(c.get('extends', '')),
+                c.get('transitive', 'true') == 'true'
+            )
+        if len(self.confs) == 0:
+            self.confs['default'] = (True, [], True)
+
+        self.defaultconfmapping = None
+        for x in [deps_xml, confs_xml]:
+            if self.defaultconfmapping is None and x is not None:
+                self.defaultconfmapping = x.get('defaultconfmapping')
+
+        self.artifacts = [] # [ (<name>, <type>, <ext>, <classifier>, { <conf> }) ]
+        if pubs_xml is None:
+            self.artifacts.append((self.id.mod, 'jar', 'jar', None, set(self.confs)))
+        else:
+            for a in pubs_xml.findall('artifact'):
+                confs = a.get('conf')
+                if confs is None:
+                    nested = [ c.get('name') for c in a.findall('conf') ]
+                    confs  = ','.join(nested) if len(nested) > 0 else pubs_xml.get('defaultconf', '*')
+                type = a.get('type', 'jar')
+                self.artifacts.append((
+                    a.get('name', self.id.mod),
+                    type,
+                    a.get('ext', type),
+                    a.get(IvyDescriptor._maven_classifier),
+                    self._conf_names(_split_conf_list(confs))
+                ))
+
+        self.dependencies = [] # [ (<id>, <mapping>, <force>, <transitive>, { (<org>, <mod>) }) ]
+        if deps_xml is not None:
+            for tag in ['exclude', 'override', 'conflict']:
+                if deps_xml.find(tag) is not None:
+                    raise EngineMiss('Unsupported element', tag, self.id.coord())
+            default_conf = deps_xml.get('defaultconf') or self.defaultconfmapping or '*->*'
+            for d in deps_xml.findall('dependency'):
+                id = ID(d.get('org', self.id.org), d.get('name'), d.get('rev'))
+                if _is_dynamic_revision(id.rev):
+                    raise EngineMiss('Dynamic revisions are not supported', id.coord(), self.id.coord())
+                if d.find('artifact') is not None or d.find('include') is not None:
+                    raise EngineMiss('Dependency artifact selection is not supported', id.coord(), self.id.coord())
+                conf = d.get('conf')
+                if conf is None:
+                    nested = []
+                    for c in d.findall('conf'):
+                        mapped = _split_conf_list(c.get('mapped', '')) + [ m.get('name') for m in c.findall('mapped') ]
+                        nested.append(c.get('name') + ('->' + ','.join(mapped) if len(mapped) > 0 else ''))
+                    conf = ';'.join(nested) if len(nested) > 0 else default_conf
+                excludes = set()
+                for e in d.findall('exclude'):
+                    unsupported = [ k for k in ['name', 'artifact', 'type', 'ext'] if e.get(k, '*') != '*' ]
+                    if len(unsupported) > 0 or e.get('matcher', 'exact') != 'exact' or e.get('conf', '') != '':
+                        raise EngineMiss('Unsupported dependency exclude', id.coord(), self.id.coord())
+                    excludes.add((e.get('org', '*'), e.get('module', '*')))
+                self.dependencies.append((
+                    id,
+                    IvyDescriptor._parse_mapping(conf),
+                    d.get('force', 'false') == 'true',
+                    d.get('transitive', 'true') == 'true',
+                    excludes
+                ))
+
+    # Return list of (<masters>, <dependency confs or None>) pairs.
+    # Example: 'compile->master(*);runtime->master(*),runtime(*)'
+    def _parse_mapping(text):
+        groups = []
+        for group in text.split(';'):
+            if group.strip() == '':
+                continue
+            if '->' in group:
+                masters, deps = group.split('->', 1)
+                groups.append((_split_conf_list(masters), _split_conf_list(deps)))
+            else:
+                groups.append((_split_conf_list(group), None))
+        return groups
+
+    # Expand '*' into all configurations.
+    def _conf_names(self, confs):
+        if '*' in confs:
+            return set(self.confs)
+        return set(confs)
+
+    # Return specified configurations and all configurations they extend
+    # in declaration order.
+    def expand(self, confs):
+        result = set()
+        todo   = list(confs)
+        while len(todo) > 0:
+            conf = todo.pop()
+            if conf in result:
+                continue
+            if not conf in self.confs:
+                raise EngineMiss('Configuration not found', conf, self.id.coord())
+            result.add(conf)
+            for x in self.confs[conf][1]:
+                todo.extend([ c for c in self.confs if c != conf ] if x.startswith('*') else [ x ])
+        return [ c for c in self.confs if c in result ]
+
+    # Return dependency configuration expressions mapped from master 'conf'.
+    def mapped(self, mapping, conf):
+        explicit = any(conf in masters for masters, deps in mapping)
+        result   = []
+        for masters, deps in mapping:
+            if '!' + conf in masters:
+                continue
+            if not (conf in masters or '*' in masters or ('%' in masters and not explicit)):
+                continue
+            if deps is None:
+                if self.defaultconfmapping is not None:
+                    deps = self.mapped(IvyDescriptor._parse_mapping(self.defaultconfmapping), conf)
+                else:
+                    deps = [ conf ] if conf in masters else [ '*' ]
+            result.extend(deps)
+        return result
+
+    # Evaluate dependency configuration expressions (from 'mapped()') against
+    # this module. Support '*', '@', '!<conf>' and fallbacks ('<conf>(<fallback>)').
+    def select(self, exprs, master):
+        result  = []
+        negated = set()
+        for expr in exprs:
+            name     = expr
+            fallback = None
+            if expr.endswith(')') and '(' in expr:
+                name, fallback = expr[:-1].split('(', 1)
+                name = name.strip()
+            if name == '@':
+                name = master
+            if name == '#':
+                raise EngineMiss('Root configuration references are not supported', self.id.coord())
+            if name.startswith('!'):
+                negated.add(name[1:])
+            elif name == '*':
+                result.extend([ c for c, (public, extends, transitive) in self.confs.items() if public ])
+            elif name in self.confs:
+                result.append(name)
+            elif fallback is not None:
+                result.extend(self.select(_split_conf_list(fallback), master))
+            else:
+                raise EngineMiss('Configuration not found', name, self.id.coord())
+        return [ c for c in dict.fromkeys(result) if not c in negated ]
+
+# Compare revisions like the ivy 'latest-revision' strategy (approximately).
+def _revision_key(rev):
+    special = { 'dev' : -3, 'alpha' : -2, 'beta' : -2, 'rc' : -1, 'final' : 0, 'ga' : 0 }
+    key     = []
+    for part in re.findall(r'\d+|[a-zA-Z]+', rev):
+        if part.isdigit():
+            key.append((1, int(part), ''))
+        else:
+            key.append((0, special.get(part.lower(), -1), part.lower()))
+    key.append((0, 0, '')) # Release marker: '1.0' > '1.0-rc1' and '1.0.1' > '1.0'.
+    return key
+
+# Compute classpaths from module definitions and artifacts in the ivy cache
+# without invoking ivy. This covers configuration mappings (including
+# fallbacks and '@'), 'extends', dependency excludes, 'force' and artifact
+# types. Conflicts are resolved by keeping the nearest forced revision, or
+# otherwise the latest revision. Modules are ordered like ivy orders
+# dependencies in resolve reports (dependents before their dependencies).
+#
+# Raise 'EngineMiss' if a module definition or artifact is missing from the
+# cache, or if a module uses ivy features that are not supported. If a
+# 'missing' list is specified, paths of missing module definitions and
+# artifacts are appended to the list instead and the traversal continues.
+class ConfigurationEngine:
+    _max_passes = 10
+
+    def __init__(self, cache, types, missing = None):
+        self._cache       = cache
+        self._types       = set(types)
+        self._missing     = missing
+        self._descriptors = dict() # { <ID> : <IvyDescriptor> }
+
+    def _miss(self, message, path):
+        if self._missing is None:
+            raise EngineMiss(message, str(path))
+        if not str(path) in self._missing:
+            self._missing.append(str(path))
+
+    # Return module descriptor, or None if missing and misses are collected.
+    def descriptor(self, id):
+        if not id in self._descriptors:
+            path = self._cache._ivy_xml_path(id)
+            if not path.exists():
+                self._miss('Module definition not in cache', path)
+                self._descriptors[id] = None
+            else:
+                self._descriptors[id] = IvyDescriptor(ET.parse(path).getroot())
+        return self._descriptors[id]
+
+    # Return list of artifact paths for specified module and configurations
+    # (equivalent to ivy '-dependency <id> -confs <confs> -cachepath').
+    def classpath(self, id, confs):
+        root_confs = [ c for cs in confs for c in _split_conf_list(cs) ]
+        selected   = dict()
+        for i in range(ConfigurationEngine._max_passes):
+            state = self._traverse(id, root_confs, selected)
+            if state['selected'] == selected:
+                break
+            selected = state['selected']
+        else:
+            raise EngineMiss('Conflict resolution did not converge', id.coord())
+
+        paths = []
+        for id in self._sort(state['order'], state['edges']):
+            descriptor = self._descriptors[id]
+            reached    = state['reached'][id]
+            for name, type, ext, classifier, artifact_confs in descriptor.artifacts:
+                if not type in self._types or len(reached & artifact_confs) == 0:
+                    continue
+                file = '-'.join([name, descriptor.id.rev] + ([classifier] if classifier else [])) + '.' + ext
+                path = Path(self._cache._cachepath) / descriptor.id.org / descriptor.id.mod / (type + 's') / file
+                if not path.exists():
+                    self._miss('Artifact not in cache', path)
+                    continue
+                path = os.path.realpath(path)
+                if not path in paths:
+                    paths.append(path)
+        return paths
+
+    def _traverse(self, id, root_confs, selected):
+        state = {
+            'reached'    : dict(), # { <ID> : { <conf> } }
+            'order'      : [],     # [ <ID> ] (discovery order)
+            'edges'      : dict(), # { <ID> : [ <ID> ] }
+            'visited'    : set(),  # { (<ID>, <conf>, <excludes>) }
+            'candidates' : dict(), # { (<org>, <mod>) : [ (<rev>, <force>, <depth>) ] }
+            'selected'   : dict()  # { (<org>, <mod>) : <rev> }
+        }
+        # The root is a forced dependency of the caller.
+        state['candidates'][(id.org, id.mod)] = [ (id.rev, True, 0) ]
+        self._visit(self.descriptor(id), root_confs, frozenset(), 1, True, selected, state)
+
+        for key, candidates in state['candidates'].items():
+            forced = [ c for c in candidates if c[1] ]
+            if len(forced) > 0:
+                nearest    = min([ c[2] for c in forced ])
+                candidates = [ c for c in forced if c[2] == nearest ]
+            state['selected'][key] = max([ c[0] for c in candidates ], key = _revision_key)
+        return state
+
+    def _visit(self, descriptor, confs, excludes, depth, transitive, selected, state):
+        if descriptor is None:
+            return # Missing (collected).
+        id = descriptor.id
+        if not id in state['reached']:
+            state['reached'][id] = set()
+            state['order'].append(id)
+            state['edges'][id] = []
+        todo = []
+        for conf in descriptor.expand(confs):
+            if not (id, conf, excludes) in state['visited']:
+                state['visited'].add((id, conf, excludes))
+                todo.append(conf)
+        state['reached'][id].update(todo)
+        if not transitive:
+            return
+
+        for dep_id, mapping, force, dep_transitive, dep_excludes in descriptor.dependencies:
+            if (dep_id.org, dep_id.mod) in excludes or (dep_id.org, '*') in excludes or ('*', dep_id.mod) in excludes:
+                continue
+            for conf in todo:
+                exprs = descriptor.mapped(mapping, conf)
+                if len(exprs) == 0:
+                    continue
+                key = (dep_id.org, dep_id.mod)
+                state['candidates'].setdefault(key, []).append((dep_id.rev, force, depth))
+                target     = ID(dep_id.org, dep_id.mod, selected.get(key, dep_id.rev))
+                dependency = self.descriptor(target)
+                if dependency is None:
+                    continue
+                if not target in state['edges'][id]:
+                    state['edges'][id].append(target)
+                self._visit(
+                    dependency,
+                    dependency.select(exprs, conf),
+                    excludes | frozenset(dep_excludes),
+                    depth + 1,
+                    dep_transitive and descriptor.confs[conf][2],
+                    selected,
+                    state
+                )
+
+    # Sort so that modules come after all modules depending on them.
+    def _sort(self, order, edges):
+        result = []
+        seen   = set()
+        def add(id):
+            if id in seen:
+                return
+            seen.add(id)
+            for dep in edges[id]:
+                add(dep)
+            result.append(id)
+        for id in order:
+            add(id)
+        result.reverse()
+        return result
+
+# Resolved module graph. Modules are numbered in the order they are added
+# and declared dependencies are stored as arrays of module numbers, which
+# keeps large transitive graphs compact once module definitions have been
+# released.
+class ModuleGraph:
+    def __init__(self):
+        self._index = dict() # { <ID> : <int> }
+        self._ids   = []     # [ <ID> ]
+        self._edges = []     # [ array('i') ], None if not added
+
+    def __contains__(self, id):
+        i = self._index.get(id)
+        return not i is None and not self._edges[i] is None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def index(self, id):
+        i = self._index.get(id)
+        if i is None:
+            i = len(self._ids)
+            self._index[id] = i
+            self._ids.append(id)
+            self._edges.append(None)
+        return i
+
+    def id(self, i):
+        return self._ids[i]
+
+    # Return array of module numbers declared as dependencies of module 'i'.
+    def edges(self, i):
+        return self._edges[i]
+
+    def add(self, id, dependencies):
+        i = self.index(id)
+        self._edges[i] = array('i', [ self.index(dep) for dep in dependencies ])
+
+    def discard(self, id):
+        i = self._index.get(id)
+        if not i is None:
+            self._edges[i] = None
+
+    # Return list of IDs of declared dependencies.
+    def dependencies(self, id):
+        ids = self._ids
+        return [ ids[j] for j in self._edges[self._index[id]] ]
 
 class Cache:
     # Private constructor.
     # Use Cache.create_cache(<name>) instead.
     def __init__(self, cachepath = CacheConstants._default_cache_name):
         self._cachepath = cachepath
-        self._modules   = dict()
+        self._modules   = dict() # { <ID> : <Module> }
+        self._graph     = ModuleGraph()
+        self._graph_snapshots = dict() # { (<ID>, <limit>) : <graph> }
         self._dependency_resolver_cache = dict()
+        self._backend   = IvyProcess(cachepath)
+        self._inputs_digest = None # (<ResolverModule._changes>, <digest>)
+        self._workers   = 1
+        self._prefetched = dict() # { <ID> : <xml root> }
+        self._engine_mode = 'ivy'
+        self._offline   = False
+        self._lockfile  = None
+        self._locked    = dict() # { (<ID>, (<conf>, ...)) : [ { 'path' : <path>, 'md5' : <md5> } ] }
+        self._unpinned  = []     # [ <module location> ]
+        self._digests   = dict() # { <path> : <md5> }
+        self._lockfile_lock = threading.Lock()
+        self.set_offline(CacheConstants._offline)
+
+    # Set the number of modules fetched concurrently by 'resolve()'.
+    def set_workers(self, workers):
+        self._workers = max(1, int(workers))
+
+    # Select how classpaths are computed:
+    #   'ivy'    -- Always resolve classpaths using ivy.
+    #   'python' -- Compute classpaths from the ivy cache using the
+    #               'ConfigurationEngine'. Use ivy on a cache miss.
+    #               Computed classpaths are not persisted or locked.
+    #   'verify' -- Resolve classpaths using ivy and report differences
+    #               against the 'ConfigurationEngine'. Persisted and
+    #               locked classpaths are not used.
+    def set_classpath_engine(self, mode):
+        if not mode in ['ivy', 'python', 'verify']:
+            raise ValueError('Unknown classpath engine', mode)
+        self._engine_mode = mode
+
+    # Return classpath computed by the 'ConfigurationEngine', or None on a miss.
+    def _engine_classpath(self, id, confs):
+        try:
+            paths = ConfigurationEngine(self, ["jar", "bundle"]).classpath(id, confs)
+        except EngineMiss as e:
+            print("Classpath engine miss [", id.coord(), "] (", confs, ")", *e.args)
+            return None
+        # Same format as classpaths read from '-cachepath' files.
+        return ':'.join(paths).split(':') + self._extra_dependencies(id, confs)
+
+    def _verify_classpath(self, id, confs, value):
+        computed = self._engine_classpath(id, confs)
+        if computed is None:
+            return
+        missing = [ x for x in value if not x in computed ]
+        extra   = [ x for x in computed if not x in value ]
+        if len(missing) == 0 and len(extra) == 0 and computed == value:
+            print("[verify] Classpath engine matches ivy [", id.coord(), "] (", confs, ")")
+            return
+        print("[verify] Classpath engine differs from ivy [", id.coord(), "] (", confs, ")")
+        for x in missing:
+            print("  - (ivy only)   ", x)
+        for x in extra:
+            print("  + (engine only)", x)
+        if len(missing) == 0 and len(extra) == 0:
+            print("  Order differs")
+            for a, b in zip(value, computed):
+                print("   ", a, "|", b)
+
+    # Return classpath without running ivy if possible, otherwise None.
+    #
+    # Persisted and locked classpaths are ivy results. Classpaths computed
+    # by the 'ConfigurationEngine' are kept in memory only, and 'verify'
+    # mode always runs ivy.
+    def _resolve_locally(self, id, confs):
+        if self._engine_mode == 'verify':
+            return None
+        value = self._load_locked_classpath(id, confs)
+        if value is not None:
+            return value
+        value = self._load_classpath(id, confs)
+        if value is None and self._engine_mode == 'python':
+            value = self._engine_classpath(id, confs)
+            if value is not None:
+                self._store_dependencies(id, confs, value, persist = False)
+        return value
+
+    # Resolve from the ivy cache only. Requests for module definitions
+    # that are missing from the cache fail immediately and ivy is run
+    # with '-useCacheOnly'. Use 'find_missing()' to list missing files
+    # up front.
+    def set_offline(self, offline):
+        self._offline = offline
+        self._backend.set_offline(offline)
+
+    # Answer ivy requests using a long-lived ivy worker instead
+    # of starting a new JVM per request. The per-request backend
+    # is used as fallback if the worker dies.
+    def use_daemon(self):
+        if self._cachepath is None or isinstance(self._backend, IvyDaemon):
+            return
+        self._backend = IvyDaemon(self._cachepath, IvyProcess(self._cachepath))
+        self._backend.set_offline(self._offline)
+        atexit.register(self._backend.close)
 
     def create_cache(name = None):
         is_default_cache_name = name == CacheConstants._default_cache_name
@@ -274,7 +977,7 @@ class Cache:
 
     def register(self, module, override = False):
         id = module.id
-        if not override and id.coord() in self._modules:
+        if not override and id in self._modules:
             raise ValueError(
                 'A definition of module',
                 id.coord(),
@@ -282,7 +985,8 @@ class Cache:
                 'Please set the override flag to override the existing definition, if intended.'
             )
         module.register(self)
-        self._modules[id.coord()] = module
+        self._modules[id] = module
+        self._graph.discard(id)
 
     def resolve_ivy_xml_from_coord(self, coord):
         return self.resolve_ivy_xml(ID.from_coord(coord))
@@ -296,46 +1000,30 @@ class Cache:
                 'Please declare all modules before attempting to resolve dependencies.'
             )
 
-        ivy_xml = Path(os.path.sep.join([
+        ivy_xml = self._ivy_xml_path(id)
+        if not ivy_xml.exists():
+            if self._offline:
+                raise ValueError('Offline mode. Module definition not in cache', str(ivy_xml))
+            self._backend.dependency(id)
+        return ivy_xml
+
+    def _ivy_xml_path(self, id):
+        return Path(os.path.sep.join([
             self._cachepath,
             id.org,
             id.mod,
             "-".join(["ivy", id.rev + ".xml"])
         ]))
-        if not ivy_xml.exists():
-            cmd = " ".join([
-                "java",
-                "-jar",
-                "tools/ivy-2.5.2.jar",
-                "-warn",
-                "-settings",
-                "settings/ivysettings.xml", # Use custom settings to add the local 'daivy' resolver.
-                "-cache",
-                self._cachepath,
-                "-dependency",
-                id.org,
-                id.mod,
-                id.rev
-            ])
-            subprocess.run(
-                cmd,
-                shell      = True,
-                executable = '/bin/bash'
-            )
-        return ivy_xml
 
     def location(self, id):
         return self.resolve_ivy_xml(id).parent
 
-    # Return list of paths to resolved jar files.
-    # NOTE: It is possible to resolve the 'ivy.xml'
-    #       file from the artifact paths, which can
-    #       be used to resolve module IDs of dependencies
-    #       for specific configurations.
-    def resolve_dependencies(self, id, confs):
-        cache_id = ';'.join([id.coord()] + confs)
-        if cache_id in self._dependency_resolver_cache:
-            return self._dependency_resolver_cache[cache_id]
+    def _resolver_cache_id(self, id, confs):
+        return (id, tuple(confs))
+
+    # Return list of jars in 'projects/<mod>-<rev>/lib', if any, which
+    # are appended to resolved classpaths of the project.
+    def _extra_dependencies(self, id, confs):
         extra_dependencies = []
         project_lib        = Path('projects') / '-'.join([id.mod, id.rev]) / 'lib'
         if project_lib.exists() and not (len(confs) == 1 and confs[0] == 'master'): # TODO: Hacky solution...
@@ -344,33 +1032,186 @@ class Cache:
                     extra_dep = Path(os.getcwd()) / dir / file
                     extra_dependencies.append(str(extra_dep))
                 break
+        return extra_dependencies
+
+    def _store_dependencies(self, id, confs, value, persist = True):
+        self._dependency_resolver_cache[self._resolver_cache_id(id, confs)] = value
+        print(" --- Resolved dependencies --- [", id.coord(), "] (", confs, ")")
+        for d in value:
+            print(" ", d)
+        print("-----------------------------------")
+        if persist:
+            self._save_classpath(id, confs, value)
+            self._lock_classpath(id, confs, value)
+        return value
+
+    # Digest of resolver inputs shared by all modules: ivy settings
+    # and locally provided modules in 'ivy-daivy-resolver-cache'.
+    # Computed once per cache instance, and again after modules are added
+    # by 'ResolverModule.add_module'.
+    def _shared_inputs_digest(self):
+        if self._inputs_digest is None or self._inputs_digest[0] != ResolverModule._changes:
+            changes = ResolverModule._changes
+            h = hashlib.sha256()
+            for root in [CacheConstants._settings_dir, ResolverModule._resources]:
+                if not root.exists():
+                    continue
+                for dir, folders, files in os.walk(root):
+                    folders.sort()
+                    for file in sorted(files):
+                        if file.endswith('.jar'): # Placeholder artifacts (see 'ResolverModule.add_module').
+                            continue
+                        path = Path(dir) / file
+                        h.update(bytes(str(path) + '\0', encoding = 'utf-8'))
+                        with open(path, 'rb') as f:
+                            h.update(hashlib.file_digest(f, 'sha256').digest())
+            self._inputs_digest = (changes, h.hexdigest())
+        return self._inputs_digest[1]
+
+    # Return the key of a persisted classpath, or None if the module
+    # definition is not available in the cache.
+    #
+    # The key covers everything that affects the resolved classpath:
+    # module coordinate and confs, the module 'ivy.xml', ivy settings,
+    # locally provided modules, and the listing of 'projects/<mod>/lib'.
+    def _classpath_key(self, id, confs):
+        ivy_xml = self.resolve_ivy_xml(id)
+        if not ivy_xml.exists():
+            return None
+        h = hashlib.sha256()
+        h.update(bytes(';'.join([id.coord()] + confs) + '\0', encoding = 'utf-8'))
+        h.update(bytes(self._shared_inputs_digest() + '\0', encoding = 'utf-8'))
+        with open(ivy_xml, 'rb') as f:
+            h.update(hashlib.file_digest(f, 'sha256').digest())
+        for extra in self._extra_dependencies(id, confs):
+            st = os.stat(extra)
+            h.update(bytes(':'.join([extra, str(st.st_size), str(st.st_mtime_ns)]) + '\0', encoding = 'utf-8'))
+        return h.hexdigest()
+
+    def _classpath_file(self, key):
+        return Path(self._cachepath) / CacheConstants._daivy_dir / 'classpaths' / (key + '.json')
+
+    # Return persisted classpath or None if there is no valid entry.
+    def _load_classpath(self, id, confs):
+        if self._cachepath is None:
+            return None
+        key = self._classpath_key(id, confs)
+        if key is None or not self._classpath_file(key).exists():
+            return None
+        with open(self._classpath_file(key), 'r') as f:
+            value = json.load(f)['classpath']
+        # Invalidate if the ivy cache has been cleaned up since.
+        for entry in value:
+            if entry != '' and not os.path.exists(entry):
+                return None
+        print("Using persisted classpath [", id.coord(), "] (", confs, ")")
+        self._dependency_resolver_cache[self._resolver_cache_id(id, confs)] = value
+        self._lock_classpath(id, confs, value)
+        return value
+
+    def _save_classpath(self, id, confs, value):
+        if self._cachepath is None:
+            return
+        key = self._classpath_key(id, confs)
+        if key is None:
+            return
+        path = self._classpath_file(key)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        temp = path.with_suffix('.tmp' + str(os.getpid()))
+        with open(temp, 'w') as f:
+            json.dump({ 'module' : id.coord(), 'confs' : confs, 'classpath' : value }, f, indent = 2)
+        os.replace(temp, path)
+
+    # Pin resolved classpaths in the lockfile at 'path'. Classpaths found
+    # in the lockfile are used without resolving after the md5 of every
+    # entry has been checked. Newly resolved classpaths are added to the
+    # lockfile. Artifacts of modules in 'unpinned' (modules built from
+    # source, whose jars are replaced in the ivy cache by the build) are
+    # recorded without md5.
+    def use_lockfile(self, path, unpinned = []):
+        self._lockfile = Path(path)
+        self._unpinned = [ os.path.realpath(Path(self._cachepath) / id.org / id.mod) + os.sep for id in unpinned ]
+        self._locked   = dict()
+        if self._lockfile.exists():
+            with open(self._lockfile, 'r') as f:
+                for entry in json.load(f)['classpaths']:
+                    key = self._resolver_cache_id(ID.from_coord(entry['module']), entry['confs'])
+                    self._locked[key] = entry['classpath']
+            print("Using lockfile", str(self._lockfile), "(" + str(len(self._locked)) + " classpaths)")
+
+    def _md5(self, path):
+        if not path in self._digests:
+            with open(path, 'rb') as f:
+                self._digests[path] = hashlib.file_digest(f, 'md5').hexdigest()
+        return self._digests[path]
+
+    # Return locked classpath or None if not in the lockfile.
+    # Raise if an entry does not match its recorded md5.
+    def _load_locked_classpath(self, id, confs):
+        entries = self._locked.get(self._resolver_cache_id(id, confs))
+        if entries is None:
+            return None
+        for entry in entries:
+            if entry['md5'] is None:
+                continue
+            if not os.path.exists(entry['path']) or self._md5(entry['path']) != entry['md5']:
+                raise ValueError(
+                    'Lockfile integrity check failed',
+                    str(self._lockfile),
+                    id.coord(),
+                    confs,
+                    entry['path'],
+                    'Remove the entry from the lockfile to resolve the classpath again.'
+                )
+        print("Using locked classpath [", id.coord(), "] (", confs, ")")
+        value = [ entry['path'] for entry in entries ]
+        self._dependency_resolver_cache[self._resolver_cache_id(id, confs)] = value
+        return value
+
+    def _lock_classpath(self, id, confs, value):
+        if self._lockfile is None:
+            return
+        key = self._resolver_cache_id(id, confs)
+        if key in self._locked:
+            return
+        entries = []
+        for path in value:
+            pinned = path != '' and os.path.exists(path) and not any(path.startswith(x) for x in self._unpinned)
+            entries.append({ 'path' : path, 'md5' : self._md5(path) if pinned else None })
+        with self._lockfile_lock:
+            self._locked[key] = entries
+            classpaths = [
+                { 'module' : locked_id.coord(), 'confs' : list(locked_confs), 'classpath' : locked_entries }
+                for (locked_id, locked_confs), locked_entries in sorted(
+                    self._locked.items(),
+                    key = lambda x: (x[0][0].coord(), x[0][1])
+                )
+            ]
+            temp = self._lockfile.with_suffix('.tmp' + str(os.getpid()))
+            with open(temp, 'w') as f:
+                json.dump({ 'classpaths' : classpaths }, f, indent = 2)
+            os.replace(temp, self._lockfile)
+
+    # Return list of paths to resolved jar files.
+    # NOTE: It is possible to resolve the 'ivy.xml'
+    #       file from the artifact paths, which can
+    #       be used to resolve module IDs of dependencies
+    #       for specific configurations.
+    def resolve_dependencies(self, id, confs):
+        cache_id = self._resolver_cache_id(id, confs)
+        if cache_id in self._dependency_resolver_cache:
+            return self._dependency_resolver_cache[cache_id]
+        local = self._resolve_locally(id, confs)
+        if local is not None:
+            return local
+        extra_dependencies = self._extra_dependencies(id, confs)
         with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
             fp.close()
-            cmd = " ".join([
-                "java",
-                "-jar",
-                "tools/ivy-2.5.2.jar",
-                "-warn",
-                "-settings",
-                "settings/ivysettings.xml", # Use custom settings to add the local 'daivy' resolver.
-                "-cache",
-                self._cachepath,
-                "-types",
-                "jar",
-                "bundle", # TODO: Add types as parameter (need bundle to get HdrHistogram)
-                "-dependency",
-                id.org,
-                id.mod,
-                id.rev,
-                "-cachepath",
-                fp.name,
-                "-confs",
-                " ".join(confs)
-            ])
-            subprocess.run(
-                cmd,
-                shell      = True,
-                executable = '/bin/bash'
+            self._backend.cachepath(
+                id,
+                confs,
+                ["jar", "bundle"], # TODO: Add types as parameter (need bundle to get HdrHistogram)
+                fp.name
             )
 
             with open(fp.name, 'r') as f:
@@ -378,31 +1219,222 @@ class Cache:
                 if len(lines) < 2:
                     line  = lines[0] if len(lines) > 0 else ""
                     value = line.strip().split(':') + extra_dependencies
-                    self._dependency_resolver_cache[cache_id] = value
-                    print(" --- Resolved dependencies --- [", id.coord(), "] (", confs, ")")
-                    for d in value:
-                        print(" ", d)
-                    print("-----------------------------------")
-                    return value
+                    if self._engine_mode == 'verify':
+                        self._verify_classpath(id, confs, value)
+                    return self._store_dependencies(id, confs, value)
                 else:
                     raise ValueError('Unexpected classpath file. Ivy dependency resolution may have failed. Lines = ', lines)
 
+    # Resolve classpaths for a list of (<id>, <confs>) pairs in one ivy run.
+    # Return a list of classpaths in the same order as the specified pairs.
+    #
+    # An aggregate module is generated with one configuration per pair, which
+    # is mapped onto the specified configurations of the specified module.
+    # After a single resolve, the classpath of each pair is read from the
+    # resolve report of its configuration in the cache (this is also how
+    # ivy computes '-cachepath').
+    #
+    # Resolved classpaths are cached like 'resolve_dependencies()'.
+    # Only pairs that cannot be resolved locally are resolved by ivy.
+    def resolve_dependencies_batch(self, requests):
+        pending = dict()
+        for id, confs in requests:
+            cache_id = self._resolver_cache_id(id, confs)
+            if cache_id in self._dependency_resolver_cache or cache_id in pending:
+                continue
+            if self._resolve_locally(id, confs) is None:
+                pending[cache_id] = (id, confs)
+
+        if len(pending) > 0:
+            batch_id = ID('daivy', 'batch-resolve', 'working')
+            pairs    = list(pending.values())
+            mappings = dict() # { <ID> : (<id>, [ <mapping> ]) }
+            bp       = blueprint()
+            bp.id(batch_id)
+            bp.artifact(None)
+            for i, (id, confs) in enumerate(pairs):
+                conf = 'p' + str(i)
+                bp.conf({ 'name' : conf })
+                target = ','.join([ c.strip() for cs in confs for c in cs.split(',') if c.strip() != '' ])
+                mappings.setdefault(id, (id, []))[1].append(conf + '->' + target)
+            for id, confmap in mappings.values():
+                # Force like the caller module used by '-dependency'.
+                bp.dep(id, { 'force' : 'true', 'conf' : ';'.join(confmap) })
+
+            print("Resolving", len(pairs), "classpaths in one ivy run")
+            with tempfile.NamedTemporaryFile(suffix = '.xml', delete_on_close=False) as fp:
+                fp.close()
+                ET.ElementTree(bp.build().load_xml()).write(fp.name)
+                self._backend.resolve(
+                    fp.name,
+                    [ 'p' + str(i) for i in range(len(pairs)) ],
+                    ["jar", "bundle"]
+                )
+
+            for i, (id, confs) in enumerate(pairs):
+                report = Path(self._cachepath) / ('-'.join([batch_id.org, batch_id.mod, 'p' + str(i)]) + '.xml')
+                if not report.exists():
+                    raise ValueError('Missing resolve report. Ivy dependency resolution may have failed.', str(report))
+                paths = Cache._report_artifact_locations(report)
+                # Same format as classpaths read from '-cachepath' files.
+                value = ':'.join(paths).split(':') + self._extra_dependencies(id, confs)
+                if self._engine_mode == 'verify':
+                    self._verify_classpath(id, confs, value)
+                self._store_dependencies(id, confs, value)
+
+        return [ self._dependency_resolver_cache[self._resolver_cache_id(id, confs)] for id, confs in requests ]
+
+    # Return local artifact files listed in an ivy resolve report in
+    # classpath order. Evicted revisions are skipped.
+    def _report_artifact_locations(path):
+        root      = ET.parse(path).getroot()
+        revisions = []
+        for revision in root.iter('revision'):
+            if revision.get('evicted') is None:
+                revisions.append(revision)
+        revisions.sort(key = lambda r: int(r.get('position', '0')))
+        locations = []
+        for revision in revisions:
+            for artifact in revision.iter('artifact'):
+                location = artifact.get('location')
+                if location is not None:
+                    location = os.path.realpath(location)
+                    if not location in locations:
+                        locations.append(location)
+        return locations
+
     def resolve(self, id, limit = 1, depth = 0):
         # Always make a recursive descent on all declared dependencies.
         # In effect, if a module is present, then so is all its
         # dependencies in all configurations. This will pull down
         # more resources than needed (e.g. test dependencies), but
         # change if/when it becomes a problem.
-        coord = id.coord()
-        if not coord in self._modules:
+        if depth == 0 and self._workers > 1 and not id in self._modules and not self._cachepath is None:
+            # Fetch missing module definitions concurrently before the
+            # (local) recursive descent registers modules in the same
+            # order as without prefetching.
+            self._prefetched = self._prefetch(id, limit)
+            try:
+                return self._resolve(id, limit, depth)
+            finally:
+                self._prefetched = dict()
+        return self._resolve(id, limit, depth)
+
+    def _resolve(self, id, limit, depth):
+        if not id in self._modules:
             if depth >= limit:
                 return None
             path   = self.resolve_ivy_xml(id)
-            module = Module(self, id, XMLFileLoader(path))
-            self._modules[coord] = module
-            for dep_id in module.declared_dependencies():
-                self.resolve(dep_id, limit, depth + 1)
-        return self._modules[coord]
+            loader = XMLFileLoader(path, self._prefetched.pop(id, None))
+            module = Module(self, id, loader)
+            self._modules[id] = module
+            # Keep only the declared dependencies in the module graph.
+            # The module definition is parsed again if requested.
+            dependencies = IvyXMLQueries.dependencies(loader.load_xml())
+            self._graph.add(id, dependencies)
+            loader.release()
+            for dep_id in dependencies:
+                self._resolve(dep_id, limit, depth + 1)
+        return self._modules[id]
+
+    def _fetch_module_xml(self, id):
+        path = self.resolve_ivy_xml(id)
+        if not path.exists():
+            return None # Reported on registration.
+        return ET.parse(path).getroot()
+
+    # Fetch module definitions of all modules within 'limit' levels of 'id'
+    # breadth-first, with all unknown modules of a level fetched concurrently
+    # by a bounded pool of workers. Return parsed module definitions.
+    #
+    # Modules are fetched on their shortest path from 'id', which covers all
+    # modules that a depth-first descent with the same limit will register.
+    def _prefetch(self, id, limit):
+        roots = dict()
+        seen  = { id }
+        level = [ id ]
+        depth = 0
+        with ThreadPoolExecutor(max_workers = self._workers) as pool:
+            while len(level) > 0 and depth < limit:
+                known   = [ x for x in level if x in self._modules ]
+                unknown = [ x for x in level if not x in self._modules ]
+                missing = [ x for x in unknown if not self._ivy_xml_path(x).exists() ]
+                if len(missing) > 0:
+                    print("Fetching", len(missing), "module definitions at depth", depth)
+                dependencies = [ self._modules[x].declared_dependencies() for x in known ]
+                for x, root in zip(unknown, pool.map(self._fetch_module_xml, unknown)):
+                    if root is not None:
+                        roots[x] = root
+                        dependencies.append(IvyXMLQueries.dependencies(root))
+                level = []
+                for deps in dependencies:
+                    for dep in deps:
+                        if not dep in seen:
+                            seen.add(dep)
+                            level.append(dep)
+                depth = depth + 1
+        return roots
+
+    # Return list of paths of module definitions and artifacts that are
+    # missing from the cache, but needed to compute the build order of 'id'
+    # within 'limit' levels and classpaths [ (<id>, <confs>) ] 'requests'.
+    # Ivy is not invoked. Classpaths that cannot be checked because of
+    # unsupported ivy features are reported and skipped.
+    def find_missing(self, id, limit, requests = []):
+        missing = []
+        key     = (id, limit)
+        if not key in self._graph_snapshots:
+            graph = self._load_graph_snapshot(id, limit)
+            if graph is None:
+                self._find_missing_definitions(id, limit, missing)
+            else:
+                self._graph_snapshots[key] = graph
+        engine = ConfigurationEngine(self, ["jar", "bundle"], missing)
+        for request_id, confs in requests:
+            if self._resolver_cache_id(request_id, confs) in self._dependency_resolver_cache:
+                continue
+            if self._ivy_xml_path(request_id).exists() and self._load_classpath(request_id, confs) is not None:
+                continue
+            try:
+                engine.classpath(request_id, confs)
+            except EngineMiss as e:
+                print("Cannot check classpath in cache [", request_id.coord(), "] (", confs, ")", *e.args)
+        return missing
+
+    # Return list of IDs of declared dependencies of 'id', or None if the
+    # module definition is not in the cache. Does not resolve 'id'.
+    def declared_dependencies(self, id):
+        if id in self._graph:
+            return self._graph.dependencies(id)
+        if id in self._modules:
+            return IvyXMLQueries.dependencies(self._modules[id]._xml_loader.load_xml())
+        if self._ivy_xml_path(id).exists():
+            return IvyXMLQueries.dependencies(ET.parse(self._ivy_xml_path(id)).getroot())
+        return None
+
+    # Walk module definitions in the cache breadth-first (see '_prefetch()').
+    def _find_missing_definitions(self, id, limit, missing):
+        seen  = { id }
+        level = [ id ]
+        depth = 0
+        while len(level) > 0 and depth < limit:
+            next = []
+            for x in level:
+                if x in self._graph:
+                    dependencies = self._graph.dependencies(x)
+                elif x in self._modules:
+                    dependencies = IvyXMLQueries.dependencies(self._modules[x]._xml_loader.load_xml())
+                elif self._ivy_xml_path(x).exists():
+                    dependencies = IvyXMLQueries.dependencies(ET.parse(self._ivy_xml_path(x)).getroot())
+                else:
+                    missing.append(str(self._ivy_xml_path(x)))
+                    continue
+                for dep in dependencies:
+                    if not dep in seen:
+                        seen.add(dep)
+                        next.append(dep)
+            level = next
+            depth = depth + 1
 
     # Intended for standalone files.
     # Does not cache and register the loaded module.
@@ -428,13 +1460,13 @@ class Cache:
         return Module(None, id, XMLTextLoader(text, root))
 
     def print_dependencies(self, module, verbose = False, visited = set(), indent = ''):
-        visited.add(module.id.coord())
+        visited.add(module.id)
 
         if verbose:
             print(indent + module.id.coord())
 
         for dep in module.declared_dependencies():
-            if not dep.coord() in visited:
+            if not dep in visited:
                 self.print_dependencies(
                     self.resolve(dep),
                     verbose,
@@ -446,64 +1478,178 @@ class Cache:
 
         if indent == '':
             print("Dependencies")
-            for key in sorted(visited):
+            for key in sorted([ x.coord() for x in visited ]):
                 print(" ", key)
 
     def compute_build_order(self, id, verbose = False, depth_limit = -1):
-        visitor = GraphVisitor()
-        visitor.visit(self.resolve(id, depth_limit), verbose, depth_limit)
-        return visitor._build_order
-
+        return self.build_graph(id, verbose, depth_limit)['build_order']
+
+    # Return the dependency graph of 'id' within 'depth_limit' levels:
+    #   'build_order' -- [ <ID> ] (dependencies before dependents)
+    #   'edges'       -- { <ID> : [ <ID> ] } (declared dependencies of
+    #                    modules visited below the depth limit)
+    #   'cycles'      -- [ [ <ID> ] ]
+    #
+    # The graph is persisted as a snapshot in the ivy cache and reused
+    # as long as the ivy.xml files it was computed from are unchanged.
+    def build_graph(self, id, verbose = False, depth_limit = -1):
+        key = (id, depth_limit)
+        if not key in self._graph_snapshots:
+            graph = self._load_graph_snapshot(id, depth_limit)
+            if graph is None:
+                visitor = GraphVisitor()
+                visitor.visit(self.resolve(id, depth_limit), verbose, depth_limit)
+                graph = {
+                    'build_order' : visitor._build_order,
+                    'edges'       : visitor._dependencies,
+                    'cycles'      : visitor._cycles
+                }
+                self._save_graph_snapshot(id, depth_limit, graph)
+            self._graph_snapshots[key] = graph
+        return self._graph_snapshots[key]
+
+    def _graph_snapshot_file(self, id, limit):
+        name = '-'.join([id.org, id.mod, id.rev, str(limit)]) + '.json'
+        return Path(self._cachepath) / CacheConstants._daivy_dir / 'graph' / name
+
+    def _file_digest(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+    # Return persisted graph or None if there is no valid snapshot.
+    # A snapshot is valid if all ivy.xml files of modules in the graph
+    # are unchanged.
+    def _load_graph_snapshot(self, id, limit):
+        if self._cachepath is None:
+            return None
+        path = self._graph_snapshot_file(id, limit)
+        if not path.exists():
+            return None
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+        for file, digest in snapshot['files']:
+            if not os.path.exists(file) or self._file_digest(file) != digest:
+                return None
+        print("Using dependency graph snapshot [", id.coord(), "] (", limit, ")")
+        ids = [ ID.from_coord(coord) for coord in snapshot['build_order'] ]
+        return {
+            'build_order' : ids,
+            'edges'       : { ids[i] : [ ids[j] for j in deps ] for i, deps in snapshot['edges'] },
+            'cycles'      : [ [ ids[i] for i in cycle ] for cycle in snapshot['cycles'] ]
+        }
+
+    def _save_graph_snapshot(self, id, limit, graph):
+        if self._cachepath is None:
+            return
+        modules = graph['build_order']
+        files   = []
+        for module in modules:
+            loader = self._modules[module]._xml_loader
+            if not isinstance(loader, XMLFileLoader):
+                return # Modules registered in memory are not tracked.
+            files.append([ str(loader.path), self._file_digest(loader.path) ])
+        index = { module : i for i, module in enumerate(modules) }
+        path  = self._graph_snapshot_file(id, limit)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        temp  = path.with_suffix('.tmp' + str(os.getpid()))
+        with open(temp, 'w') as f:
+            json.dump({
+                'module'      : id.coord(),
+                'limit'       : limit,
+                'files'       : files,
+                'build_order' : [ module.coord() for module in modules ],
+                'edges'       : [ [ index[module], [ index[dep] for dep in deps ] ] for module, deps in graph['edges'].items() ],
+                'cycles'      : [ [ index[x] for x in cycle ] for cycle in graph['cycles'] ]
+            }, f)
+        os.replace(temp, path)
+
+# Depth-first traversal of the module graph computing a build order
+# (dependencies before dependents).
+#
+# Provenance is recorded as parent edges: '_visited_from[id]' lists the
+# module from which 'id' was reached on each visit (None for the root).
+# Use 'trace()' and 'traces()' to rebuild dependency paths. Dependencies
+# leading back to a module that is still being visited are reported as
+# cycles and recorded in '_cycles'.
 class GraphVisitor:
     def __init__(self):
         self._visited      = set()
-        self._visited_from = dict() # { <coord> : [ <dependee> ] }
-        self._dependencies = dict() # { <coord> : { <coord> } }
+        self._active       = set()  # { <ID> } (entered, not yet left)
+        self._visited_from = dict() # { <ID> : [ <ID> | None ] }
+        self._dependencies = dict() # { <ID> : [ <ID> ] }
         self._build_order  = []     # [ <id> ]
-
-    def _enter(self, module, verbose, indent, trace, is_at_limit):
-        coord = module.id.coord()
-        if coord not in self._visited_from:
-            self._visited_from[coord] = []
-        self._visited_from[coord].append([x for x in trace])
-        if coord in self._visited:
+        self._cycles       = []     # [ [ <ID> ] ]
+
+    def _enter(self, module, parent, verbose, depth, limit):
+        id     = module.id
+        indent = ' '*2*depth
+        if id not in self._visited_from:
+            self._visited_from[id] = []
+        self._visited_from[id].append(parent)
+        if id in self._visited:
+            if id in self._active:
+                self._cycle(id, parent)
             if verbose:
-                print(indent[:-2] + "^ " + coord)
+                print(indent[:-2] + "^ " + id.coord())
             return False
         if verbose:
-            if is_at_limit:
-                print(indent[:-2] + "! " + coord)
+            if depth == limit:
+                print(indent[:-2] + "! " + id.coord())
             else:
-                print(indent + coord)
-        self._visited.add(coord)
+                print(indent + id.coord())
+        self._visited.add(id)
+        self._active.add(id)
         return True
 
-    def _leave(self, module, trace):
+    def _leave(self, module):
+        self._active.remove(module.id)
         self._build_order.append(module.id)
 
-    def visit(self, module, verbose = False, limit = 1, indent = '', trace = [], depth = 0):
-        coord = module.id.coord()
-        if not self._enter(module, verbose, indent, trace, depth == limit):
-            return
+    def _cycle(self, id, parent):
+        path  = self.trace(parent) + [ parent ]
+        cycle = path[path.index(id):] + [ id ]
+        self._cycles.append(cycle)
+        print("Dependency cycle:", " -> ".join([ x.coord() for x in cycle ]))
+
+    # Return declared dependencies to visit from 'module' at 'depth'.
+    def _expand(self, module, depth, limit):
         # Check +1 since resolve(..., depth + 1)
         # which returns None if depth + 1 == limit.
         if depth + 1 >= limit:
-            self._leave(module, trace)
-            return
-        dependencies              = module.declared_dependencies()
-        self._dependencies[coord] = dependencies
-        trace.append(module.id)
-        for dep in dependencies:
-            self.visit(
-                module._cache.resolve(dep, limit, depth + 1),
-                verbose,
-                limit,
-                indent + ' '*2,
-                trace,
-                depth + 1
-            )
-        trace.pop()
-        self._leave(module, trace)
+            return []
+        dependencies                  = module.declared_dependencies()
+        self._dependencies[module.id] = dependencies
+        return dependencies
+
+    # Return the dependency path from the root to the first visit of 'id'.
+    def trace(self, id):
+        trace  = []
+        parent = self._visited_from[id][0]
+        while not parent is None:
+            trace.append(parent)
+            parent = self._visited_from[parent][0]
+        trace.reverse()
+        return trace
+
+    # Return the dependency paths of all visits of 'id'.
+    def traces(self, id):
+        return [ [] if parent is None else self.trace(parent) + [ parent ] for parent in self._visited_from[id] ]
+
+    def visit(self, module, verbose = False, limit = 1):
+        stack = [] # [ [ <module>, <depth>, <dependencies>, <next dependency> ] ]
+        if self._enter(module, None, verbose, 0, limit):
+            stack.append([ module, 0, self._expand(module, 0, limit), 0 ])
+        while len(stack) > 0:
+            frame                             = stack[-1]
+            module, depth, dependencies, next = frame
+            if next == len(dependencies):
+                stack.pop()
+                self._leave(module)
+                continue
+            frame[3] = next + 1
+            dep      = module._cache.resolve(dependencies[next], limit, depth + 1)
+            if self._enter(dep, module.id, verbose, depth + 1, limit):
+                stack.append([ dep, depth + 1, self._expand(dep, depth + 1, limit), 0 ])
 
 def blueprint():
     return ModuleBlueprint()
@@ -520,6 +1666,13 @@ def cache(name = CacheConstants._default_cache_name):
 def in_memory_cache():
     return cache(None)
 
+# Resolve from the ivy cache only, in the default cache and in caches
+# created after the call (see 'Cache.set_offline').
+def set_offline(offline):
+    CacheConstants._offline = offline
+    if not CacheConstants._default_cache is None:
+        CacheConstants._default_cache.set_offline(offline)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--cache"    , required = False,
@@ -538,10 +1691,22 @@ if __name__ == "__main__":
                         help = "Enabled master configurations")
     parser.add_argument("--classpath-file", required = False,
                         help = "File to which classpath entries are written, if specified")
+    parser.add_argument("--daemon"         , required = False, action = "store_true",
+                        help = "Answer ivy requests using a long-lived ivy worker")
+    parser.add_argument("--engine"         , required = False, default = 'ivy', choices = ['ivy', 'python', 'verify'],
+                        help = "How classpaths are computed (see 'Cache.set_classpath_engine')")
+    parser.add_argument("--offline"        , required = False, action = "store_true",
+                        help = "Resolve from the ivy cache only")
 
     args  = parser.parse_args()
+    set_offline(args.offline)
     cache = Cache(args.cache) if args.cache else Cache()
 
+    if args.daemon:
+        cache.use_daemon()
+
+    cache.set_classpath_engine(args.engine)
+
     module = None
     if args.file:
         module = cache.module_from_file(args.file)
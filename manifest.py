@@ -45,33 +45,28 @@ class Manifest:
 
     def store(self, path, keys = set()):
         with open(path, 'wb') as f:
-            # Manifest MUST start with version attributes.
-            # We pop() them from the dict to force the order
-            # and therefore also need to handle re-insertion.
-            try:
-                man_ver_name = 'Manifest-Version'
-                sig_ver_name = 'Signature-Version'
-                version = self._attrib.pop(man_ver_name, None)
-                sigvers = self._attrib.pop(sig_ver_name, None)
-                if not version is None:
-                    f.write(bytes(encode_attribute(man_ver_name, version), encoding='utf-8'))
-                if not sigvers is None:
-                    f.write(bytes(encode_attribute(sig_ver_name, sigvers), encoding='utf-8'))
-                f.write(self.bytes(keys))
-                if not version is None:
-                    self._attrib[man_ver_name] = version
-                if not sigvers is None:
-                    self._attrib[sig_ver_name] = sigvers
-            except:
-                if not version is None:
-                    self._attrib[man_ver_name] = version
-                if not sigvers is None:
-                    self._attrib[sig_ver_name] = sigvers
-                raise
+            f.write(self.encoded(keys))
 
+    # Return manifest bytes. The manifest MUST start with version attributes.
+    def encoded(self, keys = set()):
+        man_ver_name = 'Manifest-Version'
+        sig_ver_name = 'Signature-Version'
+        blocks = []
+        for k in [ man_ver_name, sig_ver_name ]:
+            if k in self._attrib:
+                blocks.append(encode_attribute(k, self._attrib[k]))
+        for k, v in self._attrib.items():
+            if k in [ man_ver_name, sig_ver_name ]:
+                continue
+            if len(keys) == 0 or k in keys:
+                blocks.append(encode_attribute(k, v))
+        return bytes(''.join(blocks), encoding='utf-8')
+
+    # Lines may end with CR LF, LF or CR (see the reference).
     def load(path):
         with open(path, "rb") as f:
-            return Manifest(decode_lines(f.readlines()))
+            data = f.read().replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            return Manifest(decode_lines(data.splitlines(keepends = True)))
 
 def encode_attribute(header, value):
     space   = b'\x20'
@@ -95,6 +90,7 @@ def encode_attribute(header, value):
 def decode_lines(lines):
     space   = b'\x20'[0]
     newline = b'\x0A'[0]
+    cr      = b'\x0D'[0]
 
     i = 0
     b = None
@@ -103,15 +99,15 @@ def decode_lines(lines):
     while i < N:
         ln = lines[i]
         l0 = ln[0]
-        if l0 != newline and l0 != space:
-            b  = ln[:-1] # Start attribute line; skip newline
+        if l0 != newline and l0 != cr and l0 != space:
+            b  = ln.rstrip(b'\r\n') # Start attribute line; skip newline
             i  = i + 1
             while i < N:
                 ln = lines[i]
                 l0 = ln[0]
                 if not l0 == space:
                     break
-                b = b + ln[1:-1] # Add to line; skip space and newline
+                b = b + ln[1:].rstrip(b'\r\n') # Add to line; skip space and newline
                 i = i + 1
             l = b.decode('utf-8')
             j = l.find(':')
@@ -0,0 +1,359 @@
+#!/bin/env python3
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import stat
+import tools
+
+# Staging strategies (see 'copy'):
+#   copy     -- Copy files
+#   reflink  -- Clone files sharing data blocks until either file is
+#               written (FICLONE, e.g. btrfs and xfs), copy otherwise
+#   hardlink -- Hard link files (read-only), copy across file systems
+#   auto     -- Reflink, otherwise hard link, otherwise copy
+strategies = ['copy', 'reflink', 'hardlink', 'auto']
+_strategy  = 'copy'
+
+# ioctl request number of FICLONE (linux/fs.h).
+_FICLONE   = 0x40049409
+
+# { (<source device>, <destination device>) } where cloning failed.
+_no_reflink = set()
+
+def set_strategy(strategy):
+    global _strategy
+    if not strategy in strategies:
+        raise ValueError('Unknown staging strategy', strategy, strategies)
+    _strategy = strategy
+
+def _reflink(src, dst):
+    key = (os.stat(src).st_dev, os.stat(Path(dst).parent).st_dev)
+    if key in _no_reflink:
+        return False
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    except OSError:
+        _no_reflink.add(key)
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+def _hardlink(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno in [ errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP ]:
+            return False
+        raise
+    # Both paths refer to the same file. Make it read-only so that
+    # in-place writes through either path fail instead of silently
+    # changing the other.
+    mode = os.stat(dst).st_mode
+    if mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        os.chmod(dst, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    return True
+
+# Copy file data using 'copy_file_range' (copied by the file system,
+# which may share data blocks), or 'shutil.copy2'.
+def _copy(src, dst):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    n = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                    if n == 0:
+                        break
+                    remaining = remaining - n
+            if remaining == 0:
+                shutil.copystat(src, dst)
+                return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+# Copy 'src' to 'dst' (like 'shutil.copy2') using the staging strategy.
+#
+# An existing 'dst' is unlinked first, so that staging never writes
+# through a hard link into another file. Pass 'writable = True' for
+# destinations that are modified in place after staging; these are
+# never hard linked.
+def copy(src, dst, writable = False):
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if _strategy in ['reflink', 'auto'] and _reflink(src, dst):
+        pass
+    elif _strategy in ['hardlink', 'auto'] and not writable and _hardlink(src, dst):
+        return
+    else:
+        _copy(src, dst)
+    if writable:
+        # The source may be read-only (hard linked by an earlier build).
+        mode = os.stat(dst).st_mode
+        if not mode & stat.S_IWUSR:
+            os.chmod(dst, mode | stat.S_IWUSR)
+
+# Persistent index of files staged (copied) into a project build tree
+# (see 'compile.Project._create_source_tree').
+#
+# The index records for each staged file (relative to the project):
+#   [ <source>, <size>, <mtime_ns>, <sha256> ]
+# where size, mtime_ns and digest are those of the source when it was
+# copied. Copies preserve the modification time, so a staged file is
+# unchanged if both the source and the staged copy still have the size
+# and modification time in the index. A source with a new modification
+# time but the same digest (e.g. touched or checked out again) is not
+# copied again.
+#
+# Usage
+#   index = SnapshotIndex(project / 'var/stage-index.json', project)
+#   index.stage(src, dst) ... # For each file of the build tree
+#   index.finish()            # Delete files no longer staged
+#   index.changed             # False if the build tree is unchanged
+#   index.digests()           # Digests of the staged files
+class SnapshotIndex:
+    def __init__(self, path, root):
+        self._path    = Path(path)
+        self._root    = Path(root)
+        self._files   = SnapshotIndex._load(self._path)
+        self._staged  = set()
+        self.copied   = 0
+        self.removed  = 0
+        self.kept     = 0
+        self.changed  = False
+
+    def _load(path):
+        if not path.exists():
+            return dict()
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return dict()
+
+    def _digest(path):
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+    def _key(self, dst):
+        return str(Path(dst).relative_to(self._root))
+
+    # Return True if 'dst' was staged from 'src' and neither changed.
+    def _unchanged(self, key, src, src_stat, dst):
+        entry = self._files.get(key)
+        if entry is None or entry[0] != str(src):
+            return False
+        try:
+            dst_stat = os.stat(dst)
+        except OSError:
+            return False
+        if dst_stat.st_size != entry[1] or dst_stat.st_mtime_ns != entry[2]:
+            return False
+        if src_stat.st_size == entry[1] and src_stat.st_mtime_ns == entry[2]:
+            return True
+        if src_stat.st_size == entry[1] and SnapshotIndex._digest(src) == entry[3]:
+            # Same content. Keep the copy and record the new modification time.
+            os.utime(dst, ns = (src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            self._files[key] = [ str(src), src_stat.st_size, src_stat.st_mtime_ns, entry[3] ]
+            return True
+        return False
+
+    # Copy 'src' to 'dst' unless 'dst' is an unchanged copy of 'src'.
+    def stage(self, src, dst):
+        key = self._key(dst)
+        self._staged.add(key)
+        src_stat = os.stat(src)
+        if self._unchanged(key, src, src_stat, dst):
+            self.kept = self.kept + 1
+            return
+        dst = Path(dst)
+        if not dst.parent.exists():
+            dst.parent.mkdir(parents = True, exist_ok = True)
+        copy(src, dst)
+        self._files[key] = [ str(src), src_stat.st_size, src_stat.st_mtime_ns, SnapshotIndex._digest(src) ]
+        self.copied  = self.copied + 1
+        self.changed = True
+
+    # Return [ [ <path>, <sha256> ] ] of the files staged by this staging
+    # run, with paths relative to the project.
+    def digests(self):
+        return sorted([ [ key, self._files[key][3] ] for key in self._staged ])
+
+    # Return True if 'path' (relative to the project) was staged.
+    def __contains__(self, path):
+        return str(path) in self._staged
+
+    # Delete files that were staged before but not by this staging run,
+    # and save the index.
+    def finish(self):
+        for key in sorted(set(self._files) - self._staged):
+            path = self._root / key
+            if path.exists():
+                os.remove(path)
+                parent = path.parent
+                while parent != self._root and len(os.listdir(parent)) == 0:
+                    os.rmdir(parent)
+                    parent = parent.parent
+            del self._files[key]
+            self.removed = self.removed + 1
+            self.changed = True
+        self.save()
+        print("[stage]", self.copied, "copied,", self.removed, "removed,", self.kept, "unchanged")
+
+    def save(self):
+        self._path.parent.mkdir(parents = True, exist_ok = True)
+        temp = self._path.with_suffix('.tmp' + str(os.getpid()))
+        with open(temp, 'w') as f:
+            json.dump({ 'files' : self._files }, f, sort_keys = True)
+        os.replace(temp, self._path)
+
+# Content-addressed store of the source tree of a project ('build/'
+# without build output, see 'compile.Project._create_source_tree').
+#
+# The store holds one blob per distinct file content and the tree:
+#   <folder>/blobs/<sha256[:2]>/<sha256>
+#   <folder>/tree.json -- { 'files' : { <path> : [ <sha256>, <size>, <mtime_ns> ] },
+#                           'dirs'  : [ <path> ] }
+# with paths relative to the tree root. Size and modification time are
+# those of the files last materialized (or recorded) in the tree root,
+# and are used to reuse the tree root without reading files. Blobs are
+# staged into the tree root with the staging strategy (see 'copy').
+# Only the current tree is kept: blobs not referenced by it are deleted
+# when a tree is recorded.
+class TreeStore:
+    def __init__(self, folder):
+        self._folder = Path(folder)
+        self._file   = self._folder / 'tree.json'
+        self._blobs  = self._folder / 'blobs'
+
+    def exists(self):
+        return self._file.exists()
+
+    def mtime_ns(self):
+        return os.stat(self._file).st_mtime_ns
+
+    def load(self):
+        if not self._file.exists():
+            return None
+        try:
+            with open(self._file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, tree):
+        self._folder.mkdir(parents = True, exist_ok = True)
+        temp = self._file.with_suffix('.tmp' + str(os.getpid()))
+        with open(temp, 'w') as f:
+            json.dump(tree, f, sort_keys = True)
+        os.replace(temp, self._file)
+
+    def _blob(self, digest):
+        return self._blobs / digest[:2] / digest
+
+    # Record all files and empty folders below 'root' as the tree, except
+    # files for which 'exclude' is True. The origin of the tree is 'stage'
+    # (staged from project files) or 'zip' (unzipped from 'build.zip').
+    def record(self, root, exclude = lambda path: False, origin = 'stage'):
+        root  = Path(root)
+        files = dict()
+        dirs  = []
+        for d, subdirs, names in os.walk(root):
+            rel = Path(d).relative_to(root)
+            if len(subdirs) == 0 and len(names) == 0 and d != str(root):
+                dirs.append(str(rel))
+            for name in names:
+                path   = Path(d) / name
+                if exclude(path):
+                    continue
+                digest = SnapshotIndex._digest(path)
+                blob   = self._blob(digest)
+                if not blob.exists():
+                    blob.parent.mkdir(parents = True, exist_ok = True)
+                    copy(path, blob)
+                st = os.stat(path)
+                files[str(rel / name)] = [ digest, st.st_size, st.st_mtime_ns ]
+        tree = { 'files' : files, 'dirs' : sorted(dirs), 'origin' : origin }
+        self._save(tree)
+        self._sweep(tree)
+        return tree
+
+    # Delete blobs (and their folders) not referenced by 'tree'.
+    def _sweep(self, tree):
+        if not self._blobs.exists():
+            return
+        digests = set([ entry[0] for entry in tree['files'].values() ])
+        for folder in self._blobs.iterdir():
+            for blob in folder.iterdir():
+                if not blob.name in digests:
+                    os.unlink(blob)
+            if len(os.listdir(folder)) == 0:
+                os.rmdir(folder)
+
+    # Return True if all files of 'tree' below 'root' have the size and
+    # modification time recorded in the tree.
+    def matches(self, root, tree):
+        root = Path(root)
+        for path, (digest, size, mtime_ns) in tree['files'].items():
+            try:
+                st = os.stat(root / path)
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return False
+        return all((root / d).is_dir() for d in tree['dirs'])
+
+    # Stage the files of 'tree' into 'root' (existing files are replaced)
+    # and record their size and modification time.
+    def materialize(self, root, tree):
+        root = Path(root)
+        for d in tree['dirs']:
+            (root / d).mkdir(parents = True, exist_ok = True)
+        for path, entry in sorted(tree['files'].items()):
+            dst = root / path
+            if not dst.parent.exists():
+                dst.parent.mkdir(parents = True, exist_ok = True)
+            copy(self._blob(entry[0]), dst)
+        for path, entry in tree['files'].items():
+            st = os.stat(root / path)
+            entry[1], entry[2] = st.st_size, st.st_mtime_ns
+        self._save(tree)
+
+    # Write 'tree' as a zip file with the layout of 'shutil.make_archive'
+    # (an entry for each folder followed by its files, top-down).
+    def write_zip(self, tree, dst):
+        entries = dict()
+        for path in list(tree['files']) + tree['dirs']:
+            parts = Path(path).parts
+            for i in range(1, len(parts)):
+                entries.setdefault('/'.join(parts[:i]) + '/', None)
+        for d in tree['dirs']:
+            entries['/'.join(Path(d).parts) + '/'] = None
+        for path, entry in tree['files'].items():
+            entries['/'.join(Path(path).parts)] = entry
+        result = []
+        for name in sorted(entries):
+            entry = entries[name]
+            if entry is None:
+                result.append((name, None))
+            else:
+                result.append((name, self._blob(entry[0]), entry[2] / 1000000000, 0o644))
+        tools.write_zip(dst, result)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index",
+                        help = "Snapshot index to print (e.g. 'projects/<project>/var/stage-index.json')")
+    args = parser.parse_args()
+
+    for key, (src, size, mtime_ns, digest) in sorted(SnapshotIndex._load(Path(args.index)).items()):
+        print(key, "<=", src, size, digest[:12])
@@ -1,17 +1,103 @@
 #!/bin/env python3
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import json
+import os
 from pathlib import Path
 import shutil
+import struct
 import subprocess
 import tarfile
+import tempfile
+import time
 import zipfile
+import zlib
 from zipfile import ZipFile
 
+_offline = False
+
+# Fail instead of downloading files that are missing from the download cache.
+def set_offline(offline):
+    global _offline
+    _offline = offline
+
 def cwd_prefix(cwd):
     return '../' * len(cwd.parts)
 
+# Outputs of javacc and jjtree runs (see 'javacc') are kept in
+#   <_javacc_cache>/<key>/outputs.json -- Generated file names
+#   <_javacc_cache>/<key>/<file>       -- Generated files
+# where the key is a digest over the command, options, input files
+# (names and content), the tool jar, and the files in the output folder
+# before the run (javacc does not replace some existing files). An
+# entry is complete if 'outputs.json' exists.
+_javacc_cache = Path('build/javacc-cache')
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+# Return { <name> : (<size>, <mtime_ns>) } of files in 'folder'.
+def _folder_files(folder):
+    files = dict()
+    if not folder.is_dir():
+        return files
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                files[entry.name] = (st.st_size, st.st_mtime_ns)
+    return files
+
+def _javacc_key(rel_cwd_path, options_map, inputfile_list, javacc_jar, command, output):
+    key = [
+        command,
+        sorted(options_map.items()),
+        [ [ f, _sha256(rel_cwd_path / f) ] for f in inputfile_list ],
+        _sha256(javacc_jar),
+        sorted([ [ name, _sha256(output / name) ] for name in _folder_files(output) ])
+    ]
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+# Copy generated files of cache 'entry' into 'output'. Files with the
+# same content are kept (with their modification time).
+def _javacc_restore(entry, output, names):
+    output.mkdir(parents = True, exist_ok = True)
+    for name in names:
+        dst = output / name
+        if dst.exists() and _sha256(dst) == _sha256(entry / name):
+            continue
+        shutil.copy2(entry / name, dst)
+
+# Record files of 'output' in 'names' as cache 'entry'.
+def _javacc_store(entry, output, names):
+    _javacc_cache.mkdir(parents = True, exist_ok = True)
+    temp = Path(tempfile.mkdtemp(dir = _javacc_cache, prefix = entry.name + '.tmp'))
+    for name in names:
+        shutil.copy2(output / name, temp / name)
+    with open(temp / 'outputs.json', 'w') as f:
+        json.dump(names, f)
+    try:
+        os.rename(temp, entry)
+    except OSError:
+        shutil.rmtree(temp) # Stored by a concurrent run.
+
+# Run javacc 'command' (javacc or jjtree) in 'rel_cwd_path', or restore
+# the files generated by an earlier run with the same inputs (see
+# '_javacc_cache').
 def javacc(rel_cwd_path, options_map, inputfile_list, verbose, javacc_jar, command):
+    rel_cwd_path = Path(rel_cwd_path)
+    output       = rel_cwd_path / options_map.get('OUTPUT_DIRECTORY', '.')
+    entry        = _javacc_cache / _javacc_key(rel_cwd_path, options_map, inputfile_list, javacc_jar, command, output)
+    if (entry / 'outputs.json').exists():
+        with open(entry / 'outputs.json', 'r') as f:
+            names = json.load(f)
+        print("[javacc {}]".format(command), "Reusing", len(names), "generated files from", entry)
+        _javacc_restore(entry, output, names)
+        return
+
     parts = [
         'java',
         '-cp',
@@ -24,12 +110,23 @@ def javacc(rel_cwd_path, options_map, inputfile_list, verbose, javacc_jar, comma
     cmd = " ".join(parts + options_list + inputfile_list)
     if verbose:
         print("[javacc {}]".format(command), cmd)
-    subprocess.run(
+    before = _folder_files(output)
+    result = subprocess.run(
         cmd,
         shell      = True,
         executable = '/bin/bash',
         cwd        = rel_cwd_path
     )
+    if result.returncode == 0:
+        after = _folder_files(output)
+        names = sorted([ name for name in after if before.get(name) != after[name] ])
+        _javacc_store(entry, output, names)
+        # Running again with the generated files in place gives the same
+        # files (generated files are replaced with the same content and
+        # others are kept), so record the result for that key as well.
+        again = _javacc_cache / _javacc_key(rel_cwd_path, options_map, inputfile_list, javacc_jar, command, output)
+        if again != entry:
+            _javacc_store(again, output, names)
 
 def javacc_jjtree_7_0_12(rel_cwd_path, options_map, inputfile_list, verbose = False):
     javacc(
@@ -108,25 +205,274 @@ def unzip(src, dst):
 
     with ZipFile(src, 'r') as z:
         print('[unzip]', src, 'into', dst)
+        # Unlink existing files instead of writing into them (they
+        # may be hard links, see 'staging.py').
+        root = os.path.realpath(dst) + os.sep
+        for name in z.namelist():
+            path = os.path.realpath(os.path.join(dst, name))
+            if path.startswith(root) and not name.endswith('/') and os.path.isfile(path):
+                os.unlink(path)
         z.extractall(dst)
 
     return dst
 
+# Zip writer options (see 'set_zip_options').
+_zip_level        = 6
+_zip_workers      = os.cpu_count() or 1
+_zip_reproducible = False
+
+# Files larger than this are compressed in the writing thread in chunks
+# instead of being read into memory by a worker.
+_zip_stream_size = 64 * 1024 * 1024
+
+# Set the compression level (0 stores entries uncompressed, 1-9 deflate)
+# and the number of threads compressing entries of zip and jar files.
+# Archives are reproducible if 'reproducible' is True: entries of
+# folders are sorted, and times and modes are normalized (see
+# '_normalized'), so that the same files give byte-identical archives.
+def set_zip_options(level = None, workers = None, reproducible = None):
+    global _zip_level, _zip_workers, _zip_reproducible
+    if not reproducible is None:
+        _zip_reproducible = reproducible
+    if not level is None:
+        if not 0 <= level <= 9:
+            raise ValueError('Bad compression level (expected 0-9)', level)
+        _zip_level = level
+    if not workers is None:
+        _zip_workers = max(1, workers)
+
+# Return (<time>, <date>) of 'mtime' in MS-DOS format. Times of
+# reproducible archives (see '_normalized') are in UTC.
+def _dos_time(mtime, utc = False):
+    t = (time.gmtime if utc else time.localtime)(max(mtime, 315532800)) # Not before 1980.
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+# Return item of 'write_zip' with the time of all entries of
+# reproducible archives ('SOURCE_DATE_EPOCH' if set, otherwise
+# 1980-01-01 00:00 UTC), and modes 755 for folders and executable
+# files and 644 for other files.
+def _normalized(name, mtime, mode, source, streamed):
+    mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 315532800))
+    if name.endswith('/'):
+        mode = (0o40755 << 16) | 0x10
+    elif (mode >> 16) & 0o111:
+        mode = 0o100755 << 16
+    else:
+        mode = 0o100644 << 16
+    return name, mtime, mode, source, streamed
+
+# Return (<crc>, <size>, <data>, <method>) of 'source' (bytes or path).
+def _compress(source, level):
+    if not isinstance(source, bytes):
+        with open(source, 'rb') as f:
+            source = f.read()
+    crc = zlib.crc32(source)
+    if level == 0:
+        return crc, len(source), source, zipfile.ZIP_STORED
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return crc, len(source), c.compress(source) + c.flush(), zipfile.ZIP_DEFLATED
+
+# Writer of zip files (PKWARE APPNOTE 6.3) used by 'write_zip'. Entries
+# are written with sizes and CRC in the local header (no data
+# descriptors) and zip64 extra fields only where sizes or offsets need
+# them.
+class _ZipWriter:
+    def __init__(self, f):
+        self._f       = f
+        self._central = []
+
+    def _zip64_extra(self, values):
+        return struct.pack('<HH', 0x0001, 8 * len(values)) + b''.join([ struct.pack('<Q', v) for v in values ])
+
+    def _local_header(self, name, flags, method, dos, crc, csize, size, zip64):
+        extra   = self._zip64_extra([ size, csize ]) if zip64 else b''
+        version = 45 if zip64 else 20
+        if zip64:
+            csize, size = 0xFFFFFFFF, 0xFFFFFFFF
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, flags, method, dos[0], dos[1],
+            crc, csize, size, len(name), len(extra)
+        ) + name + extra
+
+    def add(self, name, mtime, mode, crc, size, data, method):
+        encoded  = name.encode('utf-8')
+        flags    = 0 if encoded == name.encode('ascii', errors = 'replace') else 0x800
+        dos      = _dos_time(mtime, _zip_reproducible)
+        offset   = self._f.tell()
+        zip64    = size >= 0xFFFFFFFF or len(data) >= 0xFFFFFFFF
+        self._f.write(self._local_header(encoded, flags, method, dos, crc, len(data), size, zip64))
+        self._f.write(data)
+        self._central.append((encoded, flags, method, dos, crc, len(data), size, mode, offset))
+
+    # Add file 'path' compressing it in chunks, and patch the local header
+    # once sizes and CRC are known.
+    def add_stream(self, name, mtime, mode, path, level):
+        encoded  = name.encode('utf-8')
+        flags    = 0 if encoded == name.encode('ascii', errors = 'replace') else 0x800
+        dos      = _dos_time(mtime, _zip_reproducible)
+        method   = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+        offset   = self._f.tell()
+        zip64    = os.stat(path).st_size >= 0xFFFFFFFF - 0x1000000 # Deflate may grow data.
+        self._f.write(self._local_header(encoded, flags, method, dos, 0, 0, 0, zip64))
+        c     = None if level == 0 else zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc   = 0
+        size  = 0
+        csize = 0
+        with open(path, 'rb') as src:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if len(chunk) == 0:
+                    break
+                crc  = zlib.crc32(chunk, crc)
+                size = size + len(chunk)
+                out  = chunk if c is None else c.compress(chunk)
+                self._f.write(out)
+                csize = csize + len(out)
+            if not c is None:
+                out = c.flush()
+                self._f.write(out)
+                csize = csize + len(out)
+        end = self._f.tell()
+        self._f.seek(offset)
+        self._f.write(self._local_header(encoded, flags, method, dos, crc, csize, size, zip64))
+        self._f.seek(end)
+        self._central.append((encoded, flags, method, dos, crc, csize, size, mode, offset))
+
+    def close(self):
+        start = self._f.tell()
+        for encoded, flags, method, dos, crc, csize, size, mode, offset in self._central:
+            values = [ v for v in [ size, csize, offset ] if v >= 0xFFFFFFFF ]
+            extra  = self._zip64_extra(values) if len(values) > 0 else b''
+            version = 45 if len(values) > 0 else 20
+            self._f.write(struct.pack(
+                '<IBBHHHHHIIIHHHHHII', 0x02014b50, version, 3, version, flags, method, dos[0], dos[1],
+                crc, min(csize, 0xFFFFFFFF), min(size, 0xFFFFFFFF), len(encoded), len(extra), 0, 0, 0,
+                mode, min(offset, 0xFFFFFFFF)
+            ))
+            self._f.write(encoded)
+            self._f.write(extra)
+        end   = self._f.tell()
+        count = len(self._central)
+        if count >= 0xFFFF or end - start >= 0xFFFFFFFF or start >= 0xFFFFFFFF:
+            self._f.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, end - start, start))
+            self._f.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        self._f.write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(end - start, 0xFFFFFFFF), min(start, 0xFFFFFFFF), 0
+        ))
+
+# Write zip file 'dst' with 'entries' in the given order. Each entry is
+# (<name>, <source>[, <mtime>[, <mode>]]) where the source is a path
+# (file or folder) or bytes, and None for folders (names ending with
+# '/'). Modification time and mode default to those of the source.
+# Entries are compressed concurrently by '_zip_workers' threads (zlib
+# releases the GIL) and written in order, so the output does not depend
+# on the number of threads. In reproducible mode (see
+# 'set_zip_options') all entries get the same time and normalized modes.
+def write_zip(dst, entries, level = None):
+    level = _zip_level if level is None else level
+    dst   = Path(dst)
+    dst.parent.mkdir(parents = True, exist_ok = True)
+    now   = time.time()
+
+    # [ (<name>, <mtime>, <external attributes>, <source>, <streamed>) ]
+    items = []
+    for entry in entries:
+        name, source = entry[0], entry[1]
+        st = None if source is None or isinstance(source, bytes) else os.stat(source)
+        if name.endswith('/'):
+            mode = ((st.st_mode & 0xFFFF) if not st is None else 0o40755) << 16 | 0x10
+            items.append((name, st.st_mtime if not st is None else now, mode, None, False))
+            continue
+        mode  = entry[3] if len(entry) > 3 else ((st.st_mode & 0xFFFF) if not st is None else 0o100644)
+        mode  = mode << 16
+        mtime = entry[2] if len(entry) > 2 else (st.st_mtime if not st is None else now)
+        items.append((name, mtime, mode, source, not st is None and st.st_size > _zip_stream_size))
+    if _zip_reproducible:
+        items = [ _normalized(*item) for item in items ]
+
+    temp = dst.with_name(dst.name + '.tmp' + str(os.getpid()))
+    with open(temp, 'wb') as f, ThreadPoolExecutor(max_workers = _zip_workers) as pool:
+        writer  = _ZipWriter(f)
+        pending = collections.deque()
+        window  = 4 * _zip_workers
+        def write(item, future):
+            name, mtime, mode, source, streamed = item
+            if source is None:
+                writer.add(name, mtime, mode, 0, 0, b'', zipfile.ZIP_STORED)
+            elif streamed:
+                writer.add_stream(name, mtime, mode, source, level)
+            else:
+                crc, size, data, method = future.result()
+                writer.add(name, mtime, mode, crc, size, data, method)
+        for item in items:
+            future = None
+            if not item[3] is None and not item[4]:
+                future = pool.submit(_compress, item[3], level)
+            pending.append((item, future))
+            while len(pending) > window or (len(pending) > 0 and (pending[0][1] is None or pending[0][1].done())):
+                write(*pending.popleft())
+        while len(pending) > 0:
+            write(*pending.popleft())
+        writer.close()
+    os.replace(temp, dst)
+
+# Return entries of 'src' for 'write_zip' in the order of
+# 'shutil.make_archive' (top-down, sorted folders before files in
+# directory order, or sorted files if reproducible).
+def _folder_entries(src):
+    entries = []
+    for d, dirs, files in os.walk(src):
+        if _zip_reproducible:
+            dirs.sort() # Walk order.
+        rel = os.path.relpath(d, src)
+        for name in sorted(dirs):
+            entries.append((os.path.normpath(os.path.join(rel, name)) + '/', os.path.join(d, name)))
+        for name in (sorted(files) if _zip_reproducible else files):
+            path = os.path.join(d, name)
+            if os.path.isfile(path):
+                entries.append((os.path.normpath(os.path.join(rel, name)), path))
+    return entries
+
 def _zip(src, dst):
     if src is None or dst is None:
         raise ValueError('Cannot zip', src, dst)
-    if dst.suffix == '.zip':
-        dst = dst.parent / dst.stem
     print("[zip]", str(src), str(dst))
-    shutil.make_archive(dst, 'zip', src)
+    write_zip(dst, _folder_entries(src))
 
 def zip(src, dst):
+    dst = Path(dst)
+    if dst.suffix != '.zip':
+        dst = dst.with_name(dst.name + '.zip')
     _zip(src, dst) # Call internal.
 
 def jar(src, dst):
     print("[jar]", str(src), str(dst))
     _zip(src, dst) # Call internal to avoid collision with builtin 'zip'.
-    shutil.move(str(dst) + '.zip', dst)
+
+# Write jar 'dst' from 'entries' ({ <name> : <path> }) without staging
+# the files in a folder first. The manifest ('META-INF/MANIFEST.MF'
+# bytes or None) is written first (after 'META-INF/') as required by
+# 'java.util.jar.JarInputStream'. Other entries follow in name order,
+# each preceded by entries for its folders. Line endings of the manifest
+# are normalized to LF if reproducible (see 'set_zip_options').
+def write_jar(dst, manifest, entries):
+    print("[jar]", str(dst), len(entries), "entries")
+    names = dict()
+    for name, path in entries.items():
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            names.setdefault('/'.join(parts[:i]) + '/', None)
+        names[name] = path
+    result = []
+    if not manifest is None:
+        names.pop('META-INF/', None)
+        names.pop('META-INF/MANIFEST.MF', None)
+        if _zip_reproducible:
+            manifest = manifest.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        result.append(('META-INF/', None))
+        result.append(('META-INF/MANIFEST.MF', manifest))
+    write_zip(dst, result + [ (name, names[name]) for name in sorted(names) ])
 
 def patch(src, dst):
     print("[patch]", src, dst)
@@ -181,6 +527,8 @@ def fetch(url, file, md5 = None, cache = Path('downloads')):
         print("Validating cached file", file)
     continue_download = md5 is not None and file.exists() and not is_md5(file, md5)
     if not file.exists() or continue_download:
+        if _offline:
+            raise ValueError('Offline mode. File not in download cache', str(file), url)
         print("Fetching", file, "from", url, "(" + ("continue" if continue_download else "fetch") + ")")
         cmd = " ".join([
             'wget',
@@ -0,0 +1,136 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.PrintStream;
+import java.io.Writer;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+import java.util.LinkedHashSet;
+import java.util.Set;
+
+import org.apache.ivy.Ivy;
+import org.apache.ivy.core.module.descriptor.DefaultModuleDescriptor;
+import org.apache.ivy.core.module.id.ModuleRevisionId;
+import org.apache.ivy.core.report.ArtifactDownloadReport;
+import org.apache.ivy.core.report.ResolveReport;
+import org.apache.ivy.core.resolve.ResolveOptions;
+import org.apache.ivy.util.DefaultMessageLogger;
+import org.apache.ivy.util.Message;
+import org.apache.ivy.util.filter.FilterHelper;
+
+// Long-lived ivy worker used by 'ivy_cache_resolver.IvyDaemon'.
+//
+// Usage (source launcher, JDK 11+):
+//   java -cp tools/ivy-2.5.2.jar tools/ivy-server/IvyServer.java <settings> <cache> [offline]
+//
+// Settings are loaded once. Requests are read from stdin, one per line,
+// with tab separated fields. Each request is answered by exactly one line
+// on stdout: "ok" or "error<TAB><message>". Ivy log output is redirected
+// to stderr so that stdout is reserved for the protocol.
+//
+//   dependency <org> <mod> <rev> <types>
+//   cachepath  <org> <mod> <rev> <confs> <types> <file>
+//   resolve    <ivy.xml> <confs> <types>
+//   quit
+//
+// Lists (<confs>, <types>) are comma separated. Requests mirror the ivy
+// command line options '-dependency', '-ivy', '-confs', '-types' and
+// '-cachepath'. If 'offline' is specified, all requests are resolved
+// from the cache only (ivy command line option '-useCacheOnly').
+public class IvyServer {
+
+    private static boolean useCacheOnly = false;
+
+    public static void main(String[] args) throws Exception {
+        PrintStream protocol = System.out;
+        System.setOut(System.err);
+
+        Ivy ivy = Ivy.newInstance();
+        ivy.getLoggerEngine().pushLogger(new DefaultMessageLogger(Message.MSG_WARN));
+        ivy.getSettings().addAllVariables(System.getProperties());
+        ivy.configure(new File(args[0]));
+        ivy.getSettings().setDefaultCache(new File(args[1]));
+        useCacheOnly = args.length > 2 && args[2].equals("offline");
+
+        protocol.println("ready");
+        protocol.flush();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] f = line.split("\t", -1);
+            if (f[0].equals("quit")) {
+                break;
+            }
+            try {
+                if (f[0].equals("dependency")) {
+                    resolve(ivy, f[1], f[2], f[3], new String[] { "*" }, split(f[4]));
+                } else if (f[0].equals("cachepath")) {
+                    ResolveReport report = resolve(ivy, f[1], f[2], f[3], split(f[4]), split(f[5]));
+                    writeCachePath(report, new File(f[6]));
+                } else if (f[0].equals("resolve")) {
+                    ResolveOptions options = new ResolveOptions()
+                        .setConfs(split(f[2]))
+                        .setArtifactFilter(FilterHelper.getArtifactTypeFilter(split(f[3])))
+                        .setUseCacheOnly(useCacheOnly);
+                    ResolveReport report = ivy.resolve(new File(f[1]).toURI().toURL(), options);
+                    if (report.hasError()) {
+                        throw new IllegalStateException(String.join("; ", report.getAllProblemMessages()));
+                    }
+                } else {
+                    throw new IllegalArgumentException("Unknown request '" + f[0] + "'");
+                }
+                protocol.println("ok");
+            } catch (Exception e) {
+                protocol.println("error\t" + String.valueOf(e.getMessage()).replace('\n', ' '));
+            }
+            protocol.flush();
+        }
+    }
+
+    private static String[] split(String list) {
+        return list.split("[, ]+");
+    }
+
+    // Equivalent of the ivy command line '-dependency' option, which
+    // resolves a caller module mapping 'default' onto specified confs.
+    private static ResolveReport resolve(Ivy ivy, String org, String mod, String rev, String[] confs, String[] types) throws Exception {
+        DefaultModuleDescriptor md = DefaultModuleDescriptor.newCallerInstance(
+            ModuleRevisionId.newInstance(org, mod, rev),
+            confs,
+            true,
+            false
+        );
+        ResolveOptions options = new ResolveOptions()
+            .setConfs(new String[] { "default" })
+            .setArtifactFilter(FilterHelper.getArtifactTypeFilter(types))
+            .setUseCacheOnly(useCacheOnly);
+        ResolveReport report = ivy.resolve(md, options);
+        if (report.hasError()) {
+            throw new IllegalStateException(String.join("; ", report.getAllProblemMessages()));
+        }
+        return report;
+    }
+
+    // Same format as the ivy command line '-cachepath' option.
+    private static void writeCachePath(ResolveReport report, File file) throws Exception {
+        Set<ArtifactDownloadReport> all = new LinkedHashSet<>(
+            Arrays.asList(report.getConfigurationReport("default").getAllArtifactsReports())
+        );
+        StringBuilder buf = new StringBuilder();
+        for (ArtifactDownloadReport artifact : all) {
+            if (artifact.getLocalFile() != null) {
+                if (buf.length() > 0) {
+                    buf.append(File.pathSeparator);
+                }
+                buf.append(artifact.getLocalFile().getCanonicalPath());
+            }
+        }
+        try (Writer w = new OutputStreamWriter(new FileOutputStream(file), StandardCharsets.UTF_8)) {
+            w.write(buf.toString());
+            w.write(System.lineSeparator());
+        }
+    }
+}
@@ -0,0 +1,134 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.StandardCopyOption;
+import java.security.SecureRandom;
+import java.util.Arrays;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.atomic.AtomicInteger;
+
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+// Resident javac used by 'compile.JavacServer'.
+//
+// Usage (source launcher, JDK 11+):
+//   java tools/javac-server/JavacServer.java <port-file> <idle-timeout-seconds>
+//
+// Listens on a loopback port and writes "<port> <token>" into the port
+// file once ready. Each connection carries one request line with tab
+// separated fields:
+//
+//   javac <token> <cwd> <arg>...
+//
+// Arguments are passed to 'javax.tools.JavaCompiler' like command line
+// arguments to javac, so '@<file>' options files work the same way.
+// Relative paths are resolved against the server working directory, so
+// requests from another <cwd> are rejected. The reply is a line
+// "<exit code> <length>" followed by <length> bytes of UTF-8 compiler
+// output (diagnostics). Exit code -1 means the request was rejected.
+//
+// The server exits and removes the port file when no request has been
+// received for the idle timeout.
+public class JavacServer {
+
+    public static void main(String[] args) throws Exception {
+        File portFile = new File(args[0]);
+        int  idle     = Integer.parseInt(args[1]) * 1000;
+
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        if (compiler == null) {
+            throw new IllegalStateException("No system java compiler (not running on a JDK)");
+        }
+
+        byte[] random = new byte[16];
+        new SecureRandom().nextBytes(random);
+        StringBuilder hex = new StringBuilder();
+        for (byte b : random) {
+            hex.append(String.format("%02x", b));
+        }
+        String token = hex.toString();
+        String cwd   = new File("").getAbsolutePath();
+
+        AtomicInteger active = new AtomicInteger();
+        ExecutorService pool = Executors.newCachedThreadPool(r -> {
+            Thread t = new Thread(r);
+            t.setDaemon(true);
+            return t;
+        });
+
+        try (ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress())) {
+            server.setSoTimeout(idle);
+
+            File temp = new File(portFile.getPath() + ".tmp");
+            Files.writeString(temp.toPath(), server.getLocalPort() + " " + token + "\n");
+            temp.setReadable(false, false);
+            temp.setReadable(true, true);
+            Files.move(temp.toPath(), portFile.toPath(), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+            System.err.println("javac server listening on port " + server.getLocalPort() + " (java " + System.getProperty("java.version") + ")");
+
+            while (true) {
+                Socket socket;
+                try {
+                    socket = server.accept();
+                } catch (SocketTimeoutException e) {
+                    if (active.get() == 0) {
+                        break;
+                    }
+                    continue;
+                }
+                active.incrementAndGet();
+                pool.submit(() -> {
+                    try (Socket s = socket) {
+                        handle(s, compiler, token, cwd);
+                    } catch (Exception e) {
+                        e.printStackTrace();
+                    } finally {
+                        active.decrementAndGet();
+                    }
+                });
+            }
+        } finally {
+            portFile.delete();
+        }
+        System.err.println("javac server idle, exiting");
+        System.exit(0);
+    }
+
+    private static void handle(Socket socket, JavaCompiler compiler, String token, String cwd) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(socket.getInputStream(), StandardCharsets.UTF_8));
+        String line = in.readLine();
+        String[] f  = line == null ? new String[0] : line.split("\t", -1);
+
+        ByteArrayOutputStream buf = new ByteArrayOutputStream();
+        int code;
+        if (f.length < 3 || !f[0].equals("javac") || !f[1].equals(token)) {
+            buf.writeBytes("Bad request\n".getBytes(StandardCharsets.UTF_8));
+            code = -1;
+        } else if (!f[2].equals(cwd)) {
+            buf.writeBytes(("Working directory mismatch: " + f[2] + " (server: " + cwd + ")\n").getBytes(StandardCharsets.UTF_8));
+            code = -1;
+        } else {
+            String[] javacArgs = Arrays.copyOfRange(f, 3, f.length);
+            try (PrintStream out = new PrintStream(buf, true, StandardCharsets.UTF_8)) {
+                code = compiler.run(null, out, out, javacArgs);
+            }
+        }
+
+        byte[] output = buf.toByteArray();
+        OutputStream reply = socket.getOutputStream();
+        reply.write((code + " " + output.length + "\n").getBytes(StandardCharsets.UTF_8));
+        reply.write(output);
+        reply.flush();
+    }
+}